@@ -10,3 +10,4 @@ PASSWORD = ""
 HOST = "localhost"
 PORT = "5672"
 CONFIGS = os.path.join(os.path.dirname(__file__), "tasks/*.y*ml")
+CATALOG = os.path.join(os.path.dirname(__file__), "tasks/.catalog.pickle")
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+"""
+SQLite write and read throughput with and without db.SQLITE_PRAGMAS.
+
+Runs --writers processes inserting task rows one transaction at a time, like
+insert_task(), next to --readers processes polling get_tasks_latest(), like
+the web API does.  Each profile gets a throwaway database file.  Errors, for
+example "database is locked", are counted rather than raised.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine  # type: ignore
+
+from angora.db import db
+
+
+def setup(database, pragmas):
+    engine = create_engine(f"sqlite:///{database}")
+    db.set_pragmas(engine, pragmas)
+    db.SESSION.remove()
+    db.SESSION.configure(bind=engine)
+
+
+def work(args):
+    role, seconds = args
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        try:
+            if role == "writer":
+                db.insert_task("bench", "bench.trigger", "true", "[]", None, "success")
+            else:
+                db.get_tasks_latest()
+        except Exception:  # pylint: disable=broad-except
+            errors += 1
+        else:
+            done += 1
+
+    return role, done, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    print(
+        f"{'profile':>8} {'writes/s':>10} {'write errors':>13} "
+        f"{'reads/s':>10} {'read errors':>12}"
+    )
+
+    for profile, pragmas in (("none", {}), ("default", db.SQLITE_PRAGMAS)):
+        with tempfile.TemporaryDirectory() as tmp:
+            database = os.path.join(tmp, "bench.db")
+            db.BASE.metadata.create_all(create_engine(f"sqlite:///{database}"))
+
+            jobs = [("writer", args.seconds)] * args.writers + [
+                ("reader", args.seconds)
+            ] * args.readers
+
+            with multiprocessing.Pool(
+                len(jobs), initializer=setup, initargs=(database, pragmas)
+            ) as pool:
+                results = pool.map(work, jobs)
+
+        totals = {"writer": [0, 0], "reader": [0, 0]}
+
+        for role, done, errors in results:
+            totals[role][0] += done
+            totals[role][1] += errors
+
+        print(
+            f"{profile:>8} {totals['writer'][0] / args.seconds:>10.0f} "
+            f"{totals['writer'][1]:>13} "
+            f"{totals['reader'][0] / args.seconds:>10.0f} {totals['reader'][1]:>12}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+"""
+Task status write throughput with N concurrent workers.
+
+Each worker process writes --rows task status rows, the way main.run() does,
+either with one transaction per row (insert_task) or through the process'
+coalescing task writer (queue_task).  The database is a throwaway SQLite file
+so the real log.db is never touched.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine  # type: ignore
+
+from angora.db import db
+
+
+def setup(database):
+    db.SESSION.remove()
+    db.SESSION.configure(bind=create_engine(f"sqlite:///{database}"))
+
+
+def work(args):
+    mode, rows = args
+    insert = db.insert_task if mode == "insert_task" else db.queue_task
+
+    for i in range(rows):
+        insert("bench", "bench.trigger", "true", "[]", None, f"status_{i % 3}")
+
+    db.TASK_WRITER.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--rows", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'insert_task rows/s':>20} {'queue_task rows/s':>20}")
+
+    for workers in args.workers:
+        result = []
+
+        for mode in ("insert_task", "queue_task"):
+            with tempfile.TemporaryDirectory() as tmp:
+                database = os.path.join(tmp, "bench.db")
+                engine = create_engine(f"sqlite:///{database}")
+                db.BASE.metadata.create_all(engine)
+
+                with multiprocessing.Pool(
+                    workers, initializer=setup, initargs=(database,)
+                ) as pool:
+                    start = time.perf_counter()
+                    pool.map(work, [(mode, args.rows)] * workers)
+                    elapsed = time.perf_counter() - start
+
+            result.append(workers * args.rows / elapsed)
+
+        print(f"{workers:>8} {result[0]:>20.0f} {result[1]:>20.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""
+Trigger and name lookups on a large task catalog.
+
+Writes --tasks tasks, each with a few triggers drawn from --triggers distinct
+trigger strings, to a temporary config and loads it with Tasks.  Then times
+--lookups calls to get_tasks_by_trigger() and get_task_by_name() against the
+list scan they replaced.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import yaml
+
+from angora.task import Tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--tasks", type=int, default=10000)
+    parser.add_argument("--triggers", type=int, default=50000)
+    parser.add_argument("--lookups", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    triggers = [f"bench.trigger.{_}" for _ in range(args.triggers)]
+    configs = [
+        {
+            "name": f"task_{_}",
+            "command": "true",
+            "triggers": rand.sample(triggers, 3),
+        }
+        for _ in range(args.tasks)
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "bench.yml"), "w") as cfg:
+            yaml.safe_dump(configs, cfg)
+
+        start = time.perf_counter()
+        tasks = Tasks(os.path.join(tmp, "*.y*ml"))
+        # Tasks loads lazily, load now while the config still exists
+        tasks.reload()
+        print(f"load {args.tasks} tasks: {time.perf_counter() - start:.3f}s")
+
+    all_tasks = list(tasks)
+    names = [f"task_{rand.randrange(args.tasks)}" for _ in range(args.lookups)]
+    lookups = [rand.choice(triggers) for _ in range(args.lookups)]
+
+    for label, func in (
+        ("trigger index", lambda t: tasks.get_tasks_by_trigger(t)),
+        ("trigger scan", lambda t: [_ for _ in all_tasks if t in _.triggers]),
+    ):
+        # The scan is far too slow for the full run, time a sample of it
+        sample = lookups if "index" in label else lookups[: args.lookups // 100]
+        start = time.perf_counter()
+
+        for trigger in sample:
+            func(trigger)
+
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {elapsed / len(sample) * 1e6:.2f}us per lookup")
+
+    for label, func in (
+        ("name index", lambda n: tasks.get_task_by_name(n)),
+        ("name scan", lambda n: next(_ for _ in all_tasks if _.name == n)),
+    ):
+        sample = names if "index" in label else names[: args.lookups // 100]
+        start = time.perf_counter()
+
+        for name in sample:
+            func(name)
+
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {elapsed / len(sample) * 1e6:.2f}us per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,75 @@ Angora Database
 """
 # type: ignore
 # pylint: disable=too-many-arguments,too-few-public-methods,no-member
+import atexit
+import gzip
+import json
+import logging
 import os
+import threading
+import time
+from collections import defaultdict
 from contextlib import contextmanager
-from datetime import date, datetime
-from typing import Dict, Generator, List, Optional, Union
-
-from sqlalchemy import Column, DateTime, Integer, Text, cast, create_engine
+from datetime import date, datetime, timedelta
+from queue import Empty, Queue
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    Text,
+    and_,
+    cast,
+    create_engine,
+    event,
+    func,
+    inspect,
+    text,
+)
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.sql import and_, func
 
 DATABASE = os.path.join(os.path.dirname(__file__), "log.db")
+
+# Applied to every new SQLite connection.  WAL lets the web API read while the
+# workers write, and with WAL synchronous=NORMAL is still safe from corruption,
+# only the last commits can be lost on a power failure.  Writers wait up to
+# busy_timeout ms for the lock instead of failing with "database is locked".
+# A negative cache_size is in KiB.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 10000,
+    "cache_size": -20000,
+    "mmap_size": 268435456,
+}
+
+
+def set_pragmas(engine, pragmas: Dict[str, Union[str, int]]) -> None:
+    """
+    Apply the pragmas to each connection the engine opens.
+    """
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, _) -> None:
+        cursor = dbapi_connection.cursor()
+
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+
+        cursor.close()
+
+
 ENGINE = create_engine("sqlite:///{}".format(DATABASE))
+set_pragmas(ENGINE, SQLITE_PRAGMAS)
 SESSION = scoped_session(sessionmaker(bind=ENGINE))
 BASE = declarative_base()
 
+logger = logging.getLogger(__name__)
+
 
 @contextmanager
 def _session() -> Generator:
@@ -45,6 +99,7 @@ class Messages(BASE):
     queue = Column("queue", Text)
     message = Column("message", Text)
     data = Column("data", Text)
+    source = Column("source", Text)  # Name of the task that sent the message
     time_stamp = Column(
         "time_stamp",
         DateTime(),
@@ -69,10 +124,53 @@ class Tasks(BASE):
     status = Column("status", Text)
     time_stamp = Column("time_stamp", DateTime(), default=datetime.now, index=True)
 
+    # Task history is always read for a time range, filtered by name, status or
+    # trigger.  get_tasks_latest() groups by name and joins on name, time_stamp.
+    __table_args__ = (
+        Index("ix_tasks_name_time_stamp", "name", "time_stamp"),
+        Index("ix_tasks_status_time_stamp", "status", "time_stamp"),
+        Index("ix_tasks_trigger_time_stamp", "trigger", "time_stamp"),
+    )
+
+
+class TaskLatest(BASE):
+    """
+    Task latest table
+
+    The most recent row in the tasks table for each task, same columns as
+    tasks.  It's refreshed in the same transaction as every insert into tasks,
+    so the latest status of a task is a primary key lookup.
+    """
+
+    __tablename__ = "task_latest"
+    task_id = Column("id", Integer)
+    name = Column("name", Text, primary_key=True)
+    trigger = Column("trigger", Text)
+    command = Column("command", Text)
+    parameters = Column("parameters", Text)
+    log = Column("log", Text)
+    status = Column("status", Text)
+    time_stamp = Column("time_stamp", DateTime(), index=True)
+
+
+# Copy the latest tasks row of a task into task_latest.  Rows are ordered the
+# same way get_tasks_latest() used to pick them, by time stamp, and the
+# (name, time_stamp) index makes this a single index seek.
+REFRESH_LATEST = text("""
+    INSERT OR REPLACE INTO task_latest
+        (id, name, trigger, command, parameters, log, status, time_stamp)
+    SELECT id, name, trigger, command, parameters, log, status, time_stamp
+    FROM tasks
+    WHERE name = :name
+    ORDER BY time_stamp DESC, id DESC
+    LIMIT 1
+    """)
+
 
 def init_db() -> None:
     """
-    Create database tables
+    Create database tables.  Tables that already exist are migrated, any column
+    or index they're missing is added.
     """
     if not ENGINE.dialect.has_table(ENGINE, "messages"):
         BASE.metadata.tables["messages"].create(ENGINE)
@@ -80,6 +178,82 @@ def init_db() -> None:
     if not ENGINE.dialect.has_table(ENGINE, "tasks"):
         BASE.metadata.tables["tasks"].create(ENGINE)
 
+    for table in ("messages", "tasks"):
+        _add_missing_columns(table)
+        _create_missing_indexes(table)
+
+    if not ENGINE.dialect.has_table(ENGINE, "task_latest"):
+        BASE.metadata.tables["task_latest"].create(ENGINE)
+
+        # Fill it in from the existing task history
+        with _session() as session:
+            names = [{"name": row.name} for row in session.query(Tasks.name).distinct()]
+
+            if names:
+                session.execute(REFRESH_LATEST, names)
+
+
+def ensure_db() -> None:
+    """
+    init_db() for when an Angora process starts, so a database from an older
+    version is migrated before anything is written to it.  Processes that
+    start together may race to migrate, the loser checks again.
+    """
+    try:
+        init_db()
+    except OperationalError:
+        logger.warning("Database migration raced another process, retrying")
+        init_db()
+
+
+def _add_missing_columns(table: str) -> None:
+    existing = {column["name"] for column in inspect(ENGINE).get_columns(table)}
+
+    for column in BASE.metadata.tables[table].columns:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=ENGINE.dialect)
+
+            with ENGINE.begin() as conn:
+                conn.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {column.name} {column_type}"
+                )
+
+
+def _create_missing_indexes(table: str) -> None:
+    existing = {index["name"] for index in inspect(ENGINE).get_indexes(table)}
+
+    for index in BASE.metadata.tables[table].indexes:
+        if index.name not in existing:
+            index.create(ENGINE)
+
+
+def _date_range(run_date: str) -> Optional[Tuple[datetime, datetime]]:
+    """
+    Turn a run date of YYYY, YYYY-MM or YYYY-MM-DD into a [start, end) range
+    of time stamps.  Returns None for anything else.
+    """
+    try:
+        if len(run_date) == 4:
+            start = datetime.strptime(run_date, "%Y")
+            return start, start.replace(year=start.year + 1)
+
+        if len(run_date) == 7:
+            start = datetime.strptime(run_date, "%Y-%m")
+
+            if start.month == 12:
+                return start, start.replace(year=start.year + 1, month=1)
+
+            return start, start.replace(month=start.month + 1)
+
+        if len(run_date) != 10:
+            return None
+
+        start = datetime.strptime(run_date, "%Y-%m-%d")
+    except ValueError:
+        return None
+
+    return start, start + timedelta(days=1)
+
 
 def insert_message(
     exchange: str,
@@ -87,6 +261,7 @@ def insert_message(
     message: str,
     data: Optional[Dict] = None,
     time_stamp: Optional[str] = None,
+    source: Optional[str] = None,
 ) -> None:
     """
     Insert message record into messages table
@@ -98,11 +273,50 @@ def insert_message(
                 queue=queue,
                 message=message,
                 data=str(data),
+                source=source,
                 time_stamp=time_stamp,
             )
         )
 
 
+def insert_messages(rows: List[Dict]) -> None:
+    """
+    Insert many message records into messages table with a single executemany
+    and a single commit.  Each row is a dictionary with the same keys as the
+    arguments to insert_message().
+    """
+    if not rows:
+        return
+
+    with _session() as session:
+        session.execute(Messages.__table__.insert(), rows)
+
+
+def queue_message(
+    exchange: str,
+    queue: str,
+    message: str,
+    data: Optional[Dict] = None,
+    time_stamp: Optional[str] = None,
+    source: Optional[str] = None,
+) -> None:
+    """
+    Same as insert_message() but the record is handed to MESSAGE_WRITER and
+    written in bulk later.  The time stamp is taken now, when the message is
+    received, not when the row is written.
+    """
+    MESSAGE_WRITER.put(
+        {
+            "exchange": exchange,
+            "queue": queue,
+            "message": message,
+            "data": str(data),
+            "source": source,
+            "time_stamp": time_stamp or datetime.now(),
+        }
+    )
+
+
 def get_messages_today() -> List:
     """
     Query messages inserted since the start of the current day.
@@ -125,7 +339,8 @@ def insert_task(
     time_stamp: Optional[str] = None,
 ) -> None:
     """
-    Insert task records into tasks table
+    Insert task records into tasks table, and refresh the task's row in
+    task_latest.
     """
     with _session() as session:
         session.add(
@@ -139,6 +354,53 @@ def insert_task(
                 time_stamp=time_stamp,
             )
         )
+        session.flush()
+        session.execute(REFRESH_LATEST, {"name": name})
+
+
+def insert_tasks(rows: List[Dict]) -> None:
+    """
+    Insert many task records into tasks table with a single executemany and a
+    single commit.  Each row is a dictionary with the same keys as the
+    arguments to insert_task().  task_latest is refreshed once for each task
+    in the batch.
+    """
+    if not rows:
+        return
+
+    with _session() as session:
+        session.execute(Tasks.__table__.insert(), rows)
+        session.execute(
+            REFRESH_LATEST, [{"name": name} for name in {row["name"] for row in rows}]
+        )
+
+
+def queue_task(
+    name: str,
+    trigger: str,
+    command: str,
+    parameters: str,
+    log: str,
+    status: str,
+    time_stamp: Optional[str] = None,
+) -> None:
+    """
+    Same as insert_task() but the record is handed to TASK_WRITER, which
+    coalesces the writes of every task running in this process into fewer
+    commits.  Call TASK_WRITER.flush() when the row has to be visible to other
+    processes before going on.
+    """
+    TASK_WRITER.put(
+        {
+            "name": name,
+            "trigger": trigger,
+            "command": command,
+            "parameters": parameters,
+            "log": log,
+            "status": status,
+            "time_stamp": time_stamp or datetime.now(),
+        }
+    )
 
 
 def get_tasks(
@@ -159,7 +421,15 @@ def get_tasks(
     filters = []
 
     if run_date:
-        filters.append(cast(Tasks.time_stamp, Text).startswith(run_date))
+        date_range = _date_range(run_date)
+
+        # A range can use the time_stamp indexes, matching on the text of the
+        # time stamp can't
+        if date_range:
+            filters.append(Tasks.time_stamp >= date_range[0])
+            filters.append(Tasks.time_stamp < date_range[1])
+        else:
+            filters.append(cast(Tasks.time_stamp, Text).startswith(run_date))
     if name:
         filters.append(Tasks.name == name)
     if trigger:
@@ -195,34 +465,299 @@ def get_tasks_today(status: Optional[str] = None) -> List:
 def get_tasks_latest(name: Optional[str] = None) -> List:
     """
     Query the lastest instance of each unique task since the start of the
-    current day.
+    current day.  Reads task_latest rather than aggregating the tasks table.
     """
-    filters = [Tasks.time_stamp >= date.today()]
+    filters = [TaskLatest.time_stamp >= date.today()]
 
     if name:
-        filters.append(Tasks.name == name)
+        filters.append(TaskLatest.name == name)
 
     with _session() as session:
-        max_time = (
-            session.query(Tasks.name, func.max(Tasks.time_stamp).label("time_stamp"))
-            .filter(*filters)
-            .group_by(Tasks.name)
-            .cte()
-        )
+        query = session.query(TaskLatest.__table__).filter(*filters)
+
+    return [dict(zip(row.keys(), row)) for row in query]
+
+
+def get_latest_statuses(names: Iterable[str]) -> Dict[str, str]:
+    """
+    The latest status of each of the named tasks since the start of the
+    current day, in one query.  Tasks that haven't run today are left out.
+    """
+    return {name: status for name, (status, _) in get_latest_runs(names).items()}
+
+
+def get_latest_runs(names: Iterable[str]) -> Dict[str, Tuple[str, datetime]]:
+    """
+    Same as get_latest_statuses() with the time stamp of each status.
+    """
+    names = list(names)
+
+    if not names:
+        return {}
 
+    with _session() as session:
+        query = session.query(
+            TaskLatest.name, TaskLatest.status, TaskLatest.time_stamp
+        ).filter(TaskLatest.name.in_(names), TaskLatest.time_stamp >= date.today())
+
+    return {name: (status, time_stamp) for name, status, time_stamp in query}
+
+
+def get_last_sent(sources: Iterable[str]) -> Dict[str, datetime]:
+    """
+    When the latest message from each of the named tasks was received since
+    the start of the current day, see Messages.source.
+    """
+    sources = list(sources)
+
+    if not sources:
+        return {}
+
+    with _session() as session:
         query = (
-            session.query(Tasks.__table__)
-            .join(
-                max_time,
-                and_(
-                    Tasks.name == max_time.c.name,
-                    Tasks.time_stamp == max_time.c.time_stamp,
-                ),
-            )
-            .filter(Tasks.time_stamp >= date.today())
+            session.query(Messages.source, func.max(Messages.time_stamp))
+            .filter(Messages.source.in_(sources), Messages.time_stamp >= date.today())
+            .group_by(Messages.source)
         )
 
-    return [dict(zip(row.keys(), row)) for row in query]
+    return dict(query)
+
+
+def purge(
+    before: date,
+    archive_dir: Optional[str] = None,
+    batch_size: int = 5000,
+    vacuum: bool = False,
+) -> Dict[str, int]:
+    """
+    Remove messages and tasks rows older than the before date.
+
+    When archive_dir is given, rows are first appended as JSON lines to a
+    gzipped file per table and day, e.g. tasks_2021-01-31.jsonl.gz.  Rows are
+    deleted in batches of batch_size, each batch in its own transaction, so
+    writers are never locked out for long.  The task_latest table is left
+    alone.
+
+    SQLite doesn't give back the space of deleted rows, it goes on the free
+    list and gets reused.  With vacuum set, the database is rebuilt afterward
+    to shrink the file, which can take a while on a large database.
+
+    Returns the number of rows removed from each table and the bytes freed.
+    """
+    report = {}  # type: Dict[str, int]
+    free_before = _free_bytes()
+    size_before = os.path.getsize(DATABASE)
+
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+
+    for table in (Messages.__table__, Tasks.__table__):
+        report[table.name] = 0
+
+        while True:
+            with _session() as session:
+                rows = [
+                    dict(zip(row.keys(), row))
+                    for row in session.query(table)
+                    .filter(table.c.time_stamp < before)
+                    .order_by(table.c.id)
+                    .limit(batch_size)
+                ]
+
+                if not rows:
+                    break
+
+                if archive_dir:
+                    _archive_rows(archive_dir, table.name, rows)
+
+                # The batch is the first rows by id older than before, so the id
+                # range holds no other old rows, and it binds two parameters
+                # however big the batch is.
+                session.execute(
+                    table.delete().where(
+                        and_(
+                            table.c.id.between(rows[0]["id"], rows[-1]["id"]),
+                            table.c.time_stamp < before,
+                        )
+                    )
+                )
+
+            report[table.name] += len(rows)
+
+    report["free_bytes"] = _free_bytes() - free_before
+
+    if vacuum:
+        with ENGINE.connect() as conn:
+            conn.execute("VACUUM")
+
+        report["free_bytes"] = 0
+        report["vacuum_bytes"] = size_before - os.path.getsize(DATABASE)
+
+    return report
+
+
+def _free_bytes() -> int:
+    with ENGINE.connect() as conn:
+        page_size = conn.execute("PRAGMA page_size").scalar()
+        freelist_count = conn.execute("PRAGMA freelist_count").scalar()
+
+    return page_size * freelist_count
+
+
+def _archive_rows(archive_dir: str, table: str, rows: List[Dict]) -> None:
+    """
+    Append rows to the table's archive file for the day of each row.  Appending
+    to a gzip file adds a new member, gzip readers see one continuous file.
+    """
+    days = defaultdict(list)  # type: Dict[str, List[Dict]]
+
+    for row in rows:
+        days[row["time_stamp"].strftime("%Y-%m-%d")].append(row)
+
+    for day, day_rows in days.items():
+        path = os.path.join(archive_dir, f"{table}_{day}.jsonl.gz")
+
+        with gzip.open(path, "at") as archive:
+            for row in day_rows:
+                archive.write(json.dumps(row, default=str) + "\n")
+
+
+class BufferedWriter:
+    """
+    Buffer rows in memory and write them in bulk from a background thread.
+
+    Rows are collected until there are max_rows of them or interval seconds
+    have passed since the last write, whichever comes first, and then handed
+    to the write function in one call.  put() never waits on the database.
+
+    The thread is started on first use, and restarted in a forked child since
+    threads don't survive a fork.  close() writes whatever is left and is
+    registered to run at exit, see also close_writers().  A failed write is
+    retried up to retries times, with a growing pause in between.  After that
+    the rows are logged and dropped, the buffer is not allowed to grow without
+    bound.
+    """
+
+    _STOP = object()
+    _FLUSH = object()
+
+    def __init__(
+        self,
+        write: Callable[[List[Dict]], None],
+        max_rows: int = 500,
+        interval: float = 1.0,
+        retries: int = 3,
+    ) -> None:
+        self.write = write
+        self.max_rows = max_rows
+        self.interval = interval
+        self.retries = retries
+        self._queue = Queue()  # type: Queue
+        self._thread = None  # type: Optional[threading.Thread]
+        self._pid = None  # type: Optional[int]
+        self._lock = threading.Lock()
+
+    def put(self, row: Dict) -> None:
+        if self._pid != os.getpid():
+            self._start()
+
+        self._queue.put(row)
+
+    def flush(self) -> None:
+        """
+        Write everything buffered so far and wait until it's done.
+        """
+        if self._pid != os.getpid():
+            return
+
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        done.wait()
+
+    def close(self) -> None:
+        """
+        Write everything buffered so far and stop the thread.
+        """
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+            self._pid = None
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # Anything buffered before a fork belongs to the parent
+            self._queue = Queue()
+            self._thread = threading.Thread(
+                target=self._run, name="angora-db-writer", daemon=True
+            )
+            self._pid = os.getpid()
+            self._thread.start()
+
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        rows = []  # type: List[Dict]
+        deadline = time.monotonic() + self.interval
+
+        while True:
+            try:
+                row = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                row = None
+
+            if row is self._STOP:
+                self._write(rows)
+                return
+
+            if isinstance(row, tuple) and row[0] is self._FLUSH:
+                self._write(rows)
+                rows = []
+                row[1].set()
+            elif row is not None:
+                rows.append(row)
+
+            if len(rows) >= self.max_rows or time.monotonic() >= deadline:
+                self._write(rows)
+                rows = []
+                deadline = time.monotonic() + self.interval
+
+    def _write(self, rows: List[Dict]) -> None:
+        if not rows:
+            return
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.write(rows)
+                return
+            except Exception:  # pylint: disable=broad-except
+                if attempt == self.retries:
+                    logger.exception(
+                        "Failed to write %d rows, dropping them", len(rows)
+                    )
+                    return
+
+                logger.warning("Failed to write %d rows, retrying", len(rows))
+                time.sleep(min(0.5 * 2**attempt, 5.0))
+
+
+MESSAGE_WRITER = BufferedWriter(insert_messages)
+TASK_WRITER = BufferedWriter(insert_tasks)
+
+
+def close_writers() -> None:
+    """
+    Write out everything the buffered writers hold and stop them.  For
+    shutdowns that skip atexit.
+    """
+    MESSAGE_WRITER.close()
+    TASK_WRITER.close()
 
 
 # def clearDB():
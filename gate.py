@@ -0,0 +1,177 @@
+"""
+Angora Parent Gate
+"""
+import threading
+import time
+from datetime import date
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from db import db
+from task import Task
+
+
+class GateResult:
+    """
+    Outcome of a parent success check.  When the run is blocked, blocked_by is
+    the first parent that isn't successful and status is its latest status,
+    None if it hasn't run today.
+    """
+
+    __slots__ = ("ok", "blocked_by", "status")
+
+    def __init__(
+        self, ok: bool, blocked_by: Optional[str] = None, status: Optional[str] = None
+    ) -> None:
+        self.ok = ok
+        self.blocked_by = blocked_by
+        self.status = status
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    def __repr__(self) -> str:
+        if self.ok:
+            return "GateResult(ok=True)"
+
+        return (
+            f"GateResult(ok=False, blocked_by={self.blocked_by!r}, "
+            f"status={self.status!r})"
+        )
+
+
+class ParentGate:
+    """
+    Checks that all the parents of a task succeeded before it runs.
+
+    Statuses are cached for ttl seconds.  The cache is fed by the status
+    writes of this process, see record(), and by the database lookups.  Only a
+    cached success is trusted, any other parent is looked up again, so a
+    parent that has just finished is never reported as blocking.  All the
+    parents that need a lookup are fetched with one query.
+    """
+
+    def __init__(self, ttl: float = 5.0) -> None:
+        self.ttl = ttl
+        self._statuses = {}  # type: Dict[str, Tuple[Optional[str], float]]
+        self._lock = threading.Lock()
+
+    def record(self, name: str, status: Optional[str]) -> None:
+        with self._lock:
+            self._statuses[name] = (status, time.monotonic() + self.ttl)
+
+    def check(self, parents: Iterable[str]) -> GateResult:
+        parents = list(parents)
+        now = time.monotonic()
+        statuses = {}  # type: Dict[str, Optional[str]]
+
+        with self._lock:
+            for parent in parents:
+                status, expires = self._statuses.get(parent, (None, 0.0))
+
+                if status == "success" and expires > now:
+                    statuses[parent] = status
+
+        missing = [parent for parent in parents if parent not in statuses]
+
+        if missing:
+            latest = db.get_latest_statuses(missing)
+
+            for parent in missing:
+                statuses[parent] = latest.get(parent)
+                self.record(parent, statuses[parent])
+
+        for parent in parents:
+            if statuses[parent] != "success":
+                return GateResult(False, parent, statuses[parent])
+
+        return GateResult(True)
+
+
+class Join:
+    """
+    The state of one task's join for a day.  done holds the parents that have
+    succeeded since the task was last dispatched.  credited holds parents
+    counted from the database whose success message hasn't arrived yet, the
+    message mustn't count a second time.
+    """
+
+    __slots__ = ("day", "done", "credited")
+
+    def __init__(self, day: date, done: Set[str], credited: Set[str]) -> None:
+        self.day = day
+        self.done = done
+        self.credited = credited
+
+
+class JoinTable:
+    """
+    Fan-in joins for the server.
+
+    A parent_success task with several parents used to be dispatched on every
+    parent's message and fail its own parent check until the last one.  The
+    server records which parents have succeeded instead, and the task is
+    dispatched once, when the last of them does.  Parents are known from the
+    source of their success messages.
+
+    Joins are for the current day, like the parent check.  The first time the
+    server sees a task's join, e.g. after a restart, it starts from the
+    parents that succeeded today since the task itself last ran, according to
+    the database.  After that only messages count: each dispatch starts the
+    next round empty, and a parent that was counted from the database doesn't
+    count again when its message arrives, see Join.
+    """
+
+    def __init__(self) -> None:
+        self._joins = {}  # type: Dict[str, Join]
+        self._lock = threading.Lock()
+
+    def arrive(self, task: Task, parent: str) -> bool:
+        """
+        Record that parent succeeded.  Returns True if the task should be
+        dispatched now.
+        """
+        today = date.today()
+
+        with self._lock:
+            join = self._joins.get(task.name)
+
+            if join is None:
+                join = self._joins[task.name] = self._seed(task, today, parent)
+            elif join.day != today:
+                join.day, join.done, join.credited = today, set(), set()
+
+            if parent in join.credited:
+                join.credited.discard(parent)
+                return False
+
+            join.done.add(parent)
+
+            if join.done.issuperset(task.parents):
+                join.done = set()
+                return True
+
+            return False
+
+    @staticmethod
+    def _seed(task: Task, today: date, parent: str) -> Join:
+        """
+        Start a join from the database.  A parent counted from it is credited
+        unless its message is the one arriving, or the server already received
+        a message from it since it succeeded, e.g. before a restart.
+        """
+        latest = db.get_latest_runs(list(task.parents) + [task.name])
+        _, last_run = latest.pop(task.name, (None, None))
+        done = {
+            name
+            for name, (status, time_stamp) in latest.items()
+            if status == "success" and (last_run is None or time_stamp > last_run)
+        }
+
+        sent = db.get_last_sent(done)
+        credited = {
+            name
+            for name in done - {parent}
+            if name not in sent or sent[name] < latest[name][1]
+        }
+
+        return Join(today, done, credited)
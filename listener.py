@@ -2,8 +2,11 @@
 Angora Queue
 """
 import logging
+import queue
 import socket
-from typing import Dict, Optional
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
 
 import kombu  # type: ignore
 
@@ -60,22 +63,146 @@ class Queue:
             self.user, self.password, self.host, self.port
         )
 
-    def listen(self, callbacks: Optional[list] = None) -> None:
+    def listen(
+        self,
+        callbacks: Optional[list] = None,
+        prefetch_count: Optional[int] = None,
+        ack: bool = False,
+        workers: int = 1,
+        partition: Optional[Callable[[Any], str]] = None,
+        early_ack: bool = False,
+    ) -> None:
         """
         Start a listener and handle messeages with the callback(s).  If the
         queue does not already exist in the exchange, it will be created.
+
+        By default messages are consumed with no_ack, the broker pushes the
+        whole backlog to the listener and considers it delivered.  In ack mode
+        each message is acknowledged only after all the callbacks finish, and
+        prefetch_count limits how many unacknowledged messages the broker will
+        push at once.  A message is requeued the first time a callback raises
+        and rejected if it fails again after being redelivered.  Setting a
+        prefetch_count turns on ack mode.
+
+        With more than one worker, the callbacks run on a pool of threads, see
+        Workers.  This always runs in ack mode.
+
+        With early_ack, each message is acknowledged as its callbacks start
+        rather than when they finish, and isn't redelivered if they fail.  For
+        callbacks that may run longer than the broker lets a message go
+        unacknowledged, RabbitMQ's consumer_timeout.  Prefetch still limits the
+        messages waiting to start.  Implies ack mode.
         """
+        ack = ack or bool(prefetch_count) or workers > 1 or early_ack
+
         log.info("Staring listener")
         log.info("Exchange: %s", self.queue.exchange.name)
         log.info("Queue: %s", self.queue.name)
+        log.info("Ack: %s, Prefetch: %s, Workers: %d", ack, prefetch_count, workers)
+
         with kombu.Connection(self.connection_str) as conn:
-            with kombu.Consumer(conn, [self.queue], callbacks=callbacks, no_ack=True):
+            if workers > 1:
+                self._listen_workers(
+                    conn, callbacks or [], prefetch_count, workers, partition, early_ack
+                )
+                return
+
+            if ack:
+                consumer = kombu.Consumer(
+                    conn,
+                    [self.queue],
+                    on_message=partial(self._handle, callbacks or [], early_ack),
+                    no_ack=False,
+                )
+            else:
+                consumer = kombu.Consumer(
+                    conn, [self.queue], callbacks=callbacks, no_ack=True
+                )
+
+            with consumer:
+                if prefetch_count:
+                    consumer.qos(prefetch_count=prefetch_count)
+
                 try:
                     for _ in kombu.eventloop(conn):
                         pass
                 except KeyboardInterrupt:
                     log.info("Exiting")
 
+    def _listen_workers(
+        self,
+        conn: kombu.Connection,
+        callbacks: list,
+        prefetch_count: Optional[int],
+        workers: int,
+        partition: Optional[Callable[[Any], str]],
+        early_ack: bool = False,
+    ) -> None:
+        """
+        Consume on this thread and hand each message to the worker pool.  Acks
+        have to go out on the thread that owns the connection, so the event
+        loop wakes up regularly to settle whatever the workers have finished.
+        Without an explicit prefetch_count, the broker is limited to a few
+        messages per worker.
+        """
+        pool = Workers(callbacks, workers, partition, early_ack)
+        pool.start()
+
+        with kombu.Consumer(
+            conn, [self.queue], on_message=pool.submit, no_ack=False
+        ) as consumer:
+            consumer.qos(prefetch_count=prefetch_count or workers * 4)
+
+            try:
+                while True:
+                    try:
+                        conn.drain_events(timeout=0.05)
+                    except socket.timeout:
+                        pass
+
+                    pool.settle()
+            except KeyboardInterrupt:
+                log.info("Exiting")
+            finally:
+                pool.stop()
+                pool.settle()
+
+    @staticmethod
+    def _handle(callbacks: list, early_ack: bool, message: kombu.Message) -> None:
+        """
+        Run the callbacks for one message in ack mode, then ack it.  With
+        early_ack it's acked first.
+        """
+        if early_ack:
+            message.ack()
+
+        try:
+            body = message.decode()
+
+            for callback in callbacks:
+                callback(body, message)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Callback failed")
+
+            if not early_ack:
+                settle(message, False)
+        else:
+            if not early_ack:
+                settle(message, True)
+
+    def size(self, connection: Optional[kombu.Connection] = None) -> int:
+        """
+        Number of messages waiting in the queue, not counting the ones already
+        delivered to a listener.  The queue has to exist.  Pass a connection to
+        reuse it, otherwise one is opened for the call.
+        """
+        if connection is None:
+            with kombu.Connection(self.connection_str) as conn:
+                return self.size(conn)
+
+        with connection.channel() as channel:
+            return self.queue(channel).queue_declare(passive=True).message_count
+
     def clear(self) -> None:
         """
         Clear a queue of messages.  If the queue does not exist in the exchange,
@@ -92,3 +219,119 @@ class Queue:
                     conn.drain_events(timeout=2)
                 except (socket.timeout, NotImplementedError):
                     log.info("Complete")
+
+
+def settle(message: kombu.Message, ok: bool) -> None:
+    """
+    Acknowledge a message in ack mode.  A failed message is requeued once and
+    rejected if it already came back from a redelivery.
+    """
+    if ok:
+        message.ack()
+    elif message.delivery_info.get("redelivered"):
+        log.warning("Rejecting redelivered message")
+        message.reject()
+    else:
+        log.warning("Requeueing message")
+        message.requeue()
+
+
+class Workers:
+    """
+    A pool of threads that run listener callbacks.
+
+    When a partition function is given, each worker has its own inbox and a
+    message is always sent to the inbox picked by hashing partition(body).
+    Messages with the same key are then handled one at a time and in the order
+    they arrived, while different keys run in parallel.  Without a partition
+    function all the workers share one inbox.
+
+    The workers never touch the connection.  Finished messages are put on the
+    done queue and settle() acks them from the consumer thread.  With
+    early_ack a message is put on the done queue as a worker picks it up.
+    """
+
+    def __init__(
+        self,
+        callbacks: list,
+        workers: int,
+        partition: Optional[Callable[[Any], str]] = None,
+        early_ack: bool = False,
+    ) -> None:
+        self.callbacks = callbacks
+        self.partition = partition
+        self.early_ack = early_ack
+        self.inboxes = [
+            queue.Queue() for _ in range(workers if partition else 1)
+        ]  # type: List[queue.Queue]
+        self.done = queue.Queue()  # type: queue.Queue
+        self.threads = [
+            threading.Thread(
+                target=self._work,
+                args=(self.inboxes[i % len(self.inboxes)],),
+                name=f"angora-worker-{i}",
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """
+        Let the workers finish what they already have, then shut them down.
+        """
+        for i, _ in enumerate(self.threads):
+            self.inboxes[i % len(self.inboxes)].put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+    def submit(self, message: kombu.Message) -> None:
+        body = message.decode()
+
+        if self.partition:
+            inbox = self.inboxes[hash(self.partition(body)) % len(self.inboxes)]
+        else:
+            inbox = self.inboxes[0]
+
+        inbox.put((body, message))
+
+    def settle(self) -> None:
+        """
+        Ack or requeue every message the workers have finished so far.  Only
+        call this from the thread that owns the connection.
+        """
+        while True:
+            try:
+                message, ok = self.done.get_nowait()
+            except queue.Empty:
+                return
+
+            settle(message, ok)
+
+    def _work(self, inbox: queue.Queue) -> None:
+        while True:
+            item = inbox.get()
+
+            if item is None:
+                return
+
+            body, message = item
+
+            if self.early_ack:
+                self.done.put((message, True))
+
+            try:
+                for callback in self.callbacks:
+                    callback(body, message)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Callback failed")
+
+                if not self.early_ack:
+                    self.done.put((message, False))
+            else:
+                if not self.early_ack:
+                    self.done.put((message, True))
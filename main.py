@@ -5,21 +5,35 @@ Main Angora entry point.  Start each component of Angora from here.
 import argparse
 import logging
 import os
+import signal
+import time
+from datetime import date, timedelta
 from functools import partial
-from typing import Dict
+from typing import Any, Dict, Optional
 
 import kombu
 from kombu.log import LOG_LEVELS
 import uvicorn  # type: ignore
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown
 
-from angora import CONFIGS, EXCHANGE, HOST, PASSWORD, PORT, USER
+from angora import CATALOG, CONFIGS, EXCHANGE, HOST, PASSWORD, PORT, USER
 from db import db
+from gate import JoinTable, ParentGate
 from listener import Queue
-from message import Message
-from task import Task, Tasks
+from message import Message, send_batch
+from router import STRATEGIES, Heartbeat, Router
+from task import Tasks, TaskRun
 
-TASKS = Tasks(CONFIGS)
+TASKS = Tasks(CONFIGS, CATALOG)
+PARENTS = ParentGate()
+JOINS = JoinTable()
+
+# Replay delay queues, by TTL in milliseconds
+REPLAY_TIERS = (1000, 5000, 15000, 60000, 300000, 900000, 3600000)
+
+# The server's default router, see --client-queue, --pool and --routing
+ROUTER = Router([os.uname()[1]])
 
 log = logging.getLogger()
 
@@ -32,6 +46,31 @@ app = Celery("main", inlcude="main")
 app.conf.update(accept_content=["application/json"], task_serializer="json")
 
 
+def celery_queue(name: str) -> str:
+    """
+    The Celery queue for the tasks of the client queue name.  Celery shares the
+    broker, so it can't be the client queue itself.
+    """
+    return f"celery.{name}"
+
+
+@worker_init.connect
+def migrate_db(**_: Any) -> None:
+    """
+    Bring the database up to date before the worker writes to it.
+    """
+    db.ensure_db()
+
+
+@worker_process_shutdown.connect
+def close_writers(**_: Any) -> None:
+    """
+    Prefork children end with os._exit(), which skips atexit.  Write out the
+    status rows the child still has buffered before it goes.
+    """
+    db.close_writers()
+
+
 @app.task()
 def run(payload: Dict) -> int:
     """
@@ -40,56 +79,79 @@ def run(payload: Dict) -> int:
     This is the sole Celery task.  Typically, Celery applications run different
     Python functions and are identified by Celery with the @app.task decorator.
     Angora has just one Celery task, but what we run is a shell command which
-    is executed via subprocess.
+    is executed via subprocess.  See execute().
+    """
+    return execute(payload)
+
+
+def execute(payload: Dict) -> int:
+    """
+    Run a dispatched task and record its status.  On success the task's
+    messages are sent, on failure the task goes to the replay queue.  This is
+    what both the Celery task and the native executor call.
     """
     trigger = payload["message"]
-    task = Task(**payload["data"])
-    log.info("RUN: %s", task)
 
-    if payload["queue"] == "replay":
-        status = payload["queue"]
+    try:
+        task_run = TASKS.resolve(payload["data"])
+    except LookupError as e:
+        log.error("RUN: %s", e)
+        return 1
+
+    task = task_run.task
+    log.info("RUN: %s", task_run)
+
+    if is_replay(payload):
+        status = "replay"
     else:
         status = "start"
 
-    insert_task = partial(
-        db.insert_task,
-        task.name,
-        trigger,
-        task.command,
-        str(task.parameters),
-        task.log,
-    )
+    # Status rows are coalesced by the process' task writer, and the parent
+    # gate learns about them without going to the database
+    def insert_task(status: str) -> None:
+        db.queue_task(
+            task.name,
+            trigger,
+            task_run.command,
+            str(task_run.parameters),
+            task_run.log,
+            status=status,
+        )
+        PARENTS.record(task.name, status)
 
     # Archive the task
     insert_task(status=status)
 
     # Parent Success
     if task.parent_success:
-        for parent in task.parents:
-            try:
-                status = db.get_tasks_latest(parent)[0].get("status")
-            except IndexError:
-                status = "fail"
-            finally:
-                if status != "success":
-                    # Insert fail message, no replay regardless of setting
-                    insert_task(status="fail")
+        gate = PARENTS.check(task.parents)
+
+        if not gate:
+            log.info("PARENT SUCCESS CHECK FAILED: %s", gate)
 
-                    task.write_log("PARENT SUCCESS CHECK FAILED")
+            # Insert fail message, no replay regardless of setting
+            insert_task(status="fail")
+
+            task_run.write_log(
+                f"PARENT SUCCESS CHECK FAILED: {gate.blocked_by} is {gate.status}\n"
+            )
 
-                    return 1
+            return 1
 
-    retval = task.run()
+    retval = task_run.run()
 
     # Success
     if retval == 0:
         insert_task(status="success")
 
-        # task.messages can be None or not set at all
-        for message in task.get("messages", []) or []:
-            Message(EXCHANGE, "angora", message, data=task.parameters).send(
-                USER, PASSWORD, HOST, PORT, "angora"
-            )
+        # Children may check on this task as soon as they're triggered, the
+        # success has to be in the database before the messages go out
+        db.TASK_WRITER.flush()
+
+        for message in task.messages:
+            Message(
+                EXCHANGE, "angora", message, data=task_run.parameters, source=task.name
+            ).send(USER, PASSWORD, HOST, PORT, "angora")
 
     # Failure
     else:
@@ -98,37 +160,98 @@ def run(payload: Dict) -> int:
         # Replay
         # If replay is None (infinite)
         # if replay is greater than zero
-        if task.replay is None:
-            Message(EXCHANGE, "replay", trigger, data=task).send(
-                USER, PASSWORD, HOST, PORT, "replay"
-            )
-        elif task.replay > 0:
-            Message(EXCHANGE, "replay", trigger, data=task).send(
-                USER, PASSWORD, HOST, PORT, "replay"
-            )
-            task.replay -= 1
+        delay = task_run.next_replay()
+
+        if delay is not None:
+            queue = replay_queue(delay)
+            log.info("REPLAY: %s in %.1fs via %s", task.name, delay, queue)
+
+            Message(
+                EXCHANGE, queue, trigger, data=task_run.reference(TASKS.revision)
+            ).send(USER, PASSWORD, HOST, PORT, queue, expiration=delay)
 
     return retval
 
 
 def archive(payload: Dict, _: kombu.Message) -> None:
+    """
+    Queue the message for the background archive writer, the listener never
+    waits on the database.
+    """
     log.info("ARCHIVE: %s", payload)
 
-    db.insert_message(**payload)
+    db.queue_message(**payload)
 
 
-def parse_task(payload: Dict, _: kombu.Message) -> None:
+def is_replay(payload: Dict) -> bool:
+    """
+    Replays come from "replay" or one of the "replay.<ttl>" tiers.
+    """
+    return payload["queue"].split(".")[0] == "replay"
+
+
+def parse_task(
+    payload: Dict,
+    _: kombu.Message,
+    confirm: Optional[float] = None,
+    router: Router = ROUTER,
+) -> None:
+    """
+    Find every task triggered by the message and dispatch them to the client
+    queue.  All the dispatches for one message are published as a single batch
+    over one channel.  Tasks are dispatched by reference, the client looks the
+    task up in its own copy of the configs, see Tasks.resolve().
+
+    A parent_success task with several parents is held back until the message
+    from its last parent arrives, see JoinTable.  Messages without a source,
+    e.g. triggered by hand, dispatch it right away and the client's parent
+    check decides.
+
+    The router picks the client queue for each task.  Replays expire from the
+    replay queues back to the server, and each one is dispatched again as is.
+
+    confirm is how many seconds to wait for the broker to confirm the batch,
+    None to not wait.  A batch that isn't confirmed in time raises, so the
+    listener redelivers the message.
+    """
     log.info("PARSE TASK: %s", payload)
 
-    task_queue_name = os.uname()[1]
+    if is_replay(payload):
+        queue = router.pick(TASKS.get_task_by_name(payload["data"].get("name")))
+        log.info("REPLAY: %s to %s", payload["data"].get("name"), queue)
+
+        Message(
+            EXCHANGE, payload["queue"], payload["message"], data=payload["data"]
+        ).send(USER, PASSWORD, HOST, PORT, queue)
+        return
+
     tasks = TASKS.get_tasks_by_trigger(payload["message"])
+    revision = TASKS.revision
+    batch = []
 
-    for task in tasks:
-        log.debug("Task found: %", task)
+    source = payload.get("source")
 
-        task.parameters = payload["data"]
-        Message(EXCHANGE, task_queue_name, payload["message"], data=task.dict()).send(
-            USER, PASSWORD, HOST, PORT, task_queue_name
+    for task in tasks:
+        log.debug("Task found: %s", task)
+
+        if task.parent_success and len(task.parents) > 1 and source in task.parents:
+            if not JOINS.arrive(task, source):
+                log.info("JOIN: %s waiting on parents", task.name)
+                continue
+
+        queue = router.pick(task)
+        data = TaskRun(task, payload["data"]).reference(revision)
+        batch.append((Message(EXCHANGE, queue, payload["message"], data=data), queue))
+
+    if batch:
+        send_batch(
+            batch,
+            USER,
+            PASSWORD,
+            HOST,
+            PORT,
+            confirm=confirm is not None,
+            confirm_timeout=confirm,
         )
 
 
@@ -140,59 +263,222 @@ def maintain_db(args: argparse.Namespace) -> None:
     db.init_db()
 
 
+def retention(args: argparse.Namespace) -> None:
+    """
+    Archive and delete messages and tasks older than --days.  Runs once, or
+    every --interval seconds until interrupted.
+    """
+    while True:
+        before = date.today() - timedelta(days=args.days)
+        log.info("Purging rows before %s", before)
+
+        report = db.purge(
+            before,
+            archive_dir=args.archive_dir,
+            batch_size=args.batch_size,
+            vacuum=args.vacuum,
+        )
+        log.info("Purged: %s", report)
+
+        if not args.interval:
+            break
+
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            log.info("Exiting")
+            break
+
+
+def compile_tasks(args: argparse.Namespace) -> None:
+    """
+    Parse the task configs and save them to the compiled catalog, which every
+    Angora process loads instead of parsing YAML files that haven't changed.
+    """
+    log.info("Compiled task catalog: %s", TASKS.compile())
+
+
+def replay_queue(delay: float) -> str:
+    """
+    The replay queue for a delay in seconds, the shortest tier that's at least
+    that long, or the longest tier.
+    """
+    ttl = delay * 1000
+
+    for tier in REPLAY_TIERS:
+        if tier >= ttl:
+            break
+
+    return f"replay.{tier}"
+
+
 def clear_replay(args: argparse.Namespace) -> None:
     """
-    Start the Replay queue.  The Replay queue is a RabbitMQ dead letter queue.
-    After a set amount of time, messages in the Replay queue are released to a
-    designated client task queue.  Creating the Replay queue is the same as
-    clearing it, if the queue doesn't exist when the clear() method runs then
-    the queue is created.
+    Start the Replay queues.  The Replay queues are RabbitMQ dead letter queues.
+    After a set amount of time, messages in a Replay queue are released to the
+    server's "angora" queue, or to --routing-key if given.  The server then
+    dispatches each replay to a client.  Creating the Replay queue is the same
+    as clearing it, if the queue doesn't exist when the clear() method runs
+    then the queue is created.
+
+    There is one queue per tier in REPLAY_TIERS.  A replay goes to the
+    shortest tier at least as long as its delay, and also expires on its own
+    after the delay.  RabbitMQ only expires messages at the head of a queue,
+    so a replay may wait behind a longer one, but never past its tier.  The
+    original "replay" queue is left alone, RabbitMQ won't redeclare it with
+    the new dead letter arguments.
     """
-    try:
-        server = args.routing_key
-    except AttributeError:
-        server = os.uname()[1]
-    log.info("Creating/Clearing replay queue")
+    server = getattr(args, "routing_key", None) or "angora"
+    log.info("Creating/Clearing replay queues")
     log.info("Server: %s", server)
     log.info("Exchange: %s", EXCHANGE)
-    log.info("Lifetime: %d ms", args.replayttl)
 
-    queue_args = {
-        "x-message-ttl": args.replayttl,
-        "x-dead-letter-exchange": EXCHANGE,
-        "x-dead-letter-routing-key": server,
-    }
-    Queue("replay", "replay", queue_args=queue_args).clear()
+    for tier in REPLAY_TIERS:
+        name = f"replay.{tier}"
+        queue_args = {
+            "x-message-ttl": tier,
+            "x-dead-letter-exchange": EXCHANGE,
+            "x-dead-letter-routing-key": server,
+        }
+        Queue(name, name, queue_args=queue_args).clear()
+
+
+def trigger_key(payload: Dict) -> str:
+    """
+    Partition key for the server workers.  Messages with the same trigger are
+    dispatched in the order they arrived.
+    """
+    return payload["message"]
+
+
+def stop(signum: int, _: Any) -> None:
+    """
+    SIGTERM handler for the listeners.  Stop the same way as on Ctrl-C, the
+    listener winds down and the buffered writers are closed, see
+    db.close_writers().  A plain SIGTERM would skip atexit and lose them.
+    """
+    log.info("Received signal %d", signum)
+
+    raise KeyboardInterrupt
 
 
 def start_server(args: argparse.Namespace) -> None:
     """
     Start the Angora server.  It's a RabbitMQ queue named "angora".  There are
-    two callbacks, archive(), and parse_task().
+    two callbacks, archive(), and parse_task().  See Queue.listen() for the
+    --ack and --prefetch consumer options.
+
+    Tasks and replays are dispatched to the --client-queue queues, or a --pool
+    a task is pinned to, picked by the --routing strategy.
+    With --confirm, each batch waits that many seconds for the broker to
+    confirm it, and a batch that isn't confirmed is redelivered to the server.
+    With --workers greater than one, the callbacks run on that many dispatcher
+    threads.  Messages are partitioned by trigger, so the same trigger is
+    always handled by the same worker.  With --watch, changes to the task
+    configs are picked up without a restart.
     """
     log.info("Starting Angora server")
 
+    db.ensure_db()
+
+    pools = {}
+
+    for pool in args.pool or []:
+        name, _, queues = pool.partition("=")
+        pools[name] = queues.split(",")
+
+    router = Router(args.client_queue or ROUTER.queues, pools, args.routing)
+    log.info("Client queues: %s, pools: %s", router.queues, router.pools)
+
+    if args.routing == "least-outstanding":
+        router.listen_heartbeats()
+
     clear_replay(args)
 
-    callbacks = [archive, parse_task]
-    Queue("angora", "angora").listen(callbacks)
+    if args.watch:
+        TASKS.watch(args.watch)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    callbacks = [archive, partial(parse_task, confirm=args.confirm, router=router)]
+
+    try:
+        Queue("angora", "angora").listen(
+            callbacks,
+            prefetch_count=args.prefetch,
+            ack=args.ack or args.confirm is not None,
+            workers=args.workers,
+            partition=trigger_key,
+        )
+    finally:
+        db.close_writers()
 
 
 def start_client(args: argparse.Namespace) -> None:
     """
     Start an Angora task client.  It's a RabbitMQ queue.  The default name is
     the name of the local host.  There are two callbacks, archive() and a lambda
-    function that calls run.delay().  The delay() executes run() as a Celery
-    task.
+    function that calls run.apply_async().  That executes run() as a Celery
+    task on the client's own Celery queue, so only the workers started with
+    its --queue-name as their --queue pick it up, see start_celery().  With --ack or --prefetch
+    the message is acknowledged once the task has been handed to Celery.
+
+    With --executor native there's no Celery.  The client runs the tasks itself
+    on --concurrency threads.  Each message is acknowledged as its task starts,
+    a task can run for longer than RabbitMQ's consumer_timeout allows a message
+    to go unacknowledged.  Only one message waits for a free thread unless
+    --prefetch says otherwise, so tasks aren't held by a busy client.
+
+    With --heartbeat, every that many seconds the client tells the server how
+    much work it has outstanding, for the least-outstanding routing strategy.
     """
-    callbacks = [archive, lambda x, _: run.delay(x)]
-    Queue(args.queue_name, args.queue_name).listen(callbacks)
+    db.ensure_db()
+
+    queue = Queue(args.queue_name, args.queue_name)
+    backlog = [queue]
+
+    if args.executor == "celery":
+        backlog.append(Queue(celery_queue(args.queue_name), args.queue_name))
+
+    heartbeat = Heartbeat(backlog, args.heartbeat)
+
+    if args.heartbeat:
+        heartbeat.start()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        if args.executor == "native":
+
+            def execute_tracked(payload: Dict, _: kombu.Message) -> None:
+                with heartbeat.track():
+                    execute(payload)
+
+            queue.listen(
+                [archive, execute_tracked],
+                prefetch_count=args.prefetch or 1,
+                workers=args.concurrency,
+                early_ack=True,
+            )
+        else:
+            callbacks = [
+                archive,
+                lambda x, _: run.apply_async((x,), queue=celery_queue(args.queue_name)),
+            ]
+            queue.listen(callbacks, prefetch_count=args.prefetch, ack=args.ack)
+    finally:
+        db.close_writers()
 
 
 def start_celery(args: argparse.Namespace) -> None:
+    """
+    Start a Celery worker for the tasks of one client, the one with the same
+    --queue-name as this worker's --queue, see celery_queue().
+    """
     app.worker_main(
         argv=[
             "worker",
+            f"--queues={celery_queue(args.queue)}",
             f"--concurrency={args.concurrency}",
             f"--loglevel={args.loglevel}",
             f"--logfile={args.logfile}",
@@ -213,33 +499,84 @@ def start_web(args: argparse.Namespace) -> None:
     )
 
 
+def add_consumer_arguments(subparser: argparse.ArgumentParser) -> None:
+    """
+    Consumer options shared by the server and client listeners.
+    """
+    subparser.add_argument(
+        "--ack",
+        action="store_true",
+        help="Acknowledge each message after its callbacks finish, unacked "
+        "messages are redelivered if the listener dies",
+    )
+    subparser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Maximum number of unacknowledged messages the broker will push to "
+        "the listener, implies --ack",
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Angora command line tool")
     subparsers = parser.add_subparsers(dest="cmd")
     subparsers.required = True
 
     # Replay
-    replay_subparser = subparsers.add_parser("replay", help="Create/Clear replay queue")
-    replay_subparser.add_argument(
-        "--routing-key",
-        help="Name of queue that replay queue will release messages to, default is local host name",
+    replay_subparser = subparsers.add_parser(
+        "replay", help="Create/Clear replay queues"
     )
     replay_subparser.add_argument(
-        "--ttl",
-        type=int,
-        help="Queue lifetime in milliseconds, default is 10 minutes",
-        default=600000,
+        "--routing-key",
+        help="Name of queue that replay queue will release messages to, default "
+        "is the server",
     )
     replay_subparser.set_defaults(func=clear_replay)
 
     # Server
     server_subparser = subparsers.add_parser("server", help="Start Angora server")
     server_subparser.add_argument(
-        "--replayttl",
+        "--confirm",
+        type=float,
+        nargs="?",
+        const=30.0,
+        metavar="SECONDS",
+        help="Wait up to SECONDS, 30 by default, for publisher confirms on each "
+        "batch of dispatched tasks, implies --ack",
+    )
+    server_subparser.add_argument(
+        "--watch",
+        type=float,
+        help="Check the task configs for changes every this many seconds and "
+        "reload them",
+    )
+    server_subparser.add_argument(
+        "--client-queue",
+        action="append",
+        help="Client queue to dispatch tasks to, repeat for each client, default "
+        "is the name of the local host",
+    )
+    server_subparser.add_argument(
+        "--pool",
+        action="append",
+        help="A named pool of client queues, NAME=QUEUE[,QUEUE...], for tasks "
+        "pinned to it, repeat for each pool",
+    )
+    server_subparser.add_argument(
+        "--routing",
+        choices=STRATEGIES,
+        default="round-robin",
+        help="How to pick the client queue for a task, least-outstanding uses "
+        "the client heartbeats, start the clients with --heartbeat, default is "
+        "round-robin",
+    )
+    server_subparser.add_argument(
+        "--workers",
         type=int,
-        help="Queue lifetime in milliseconds, default is 10 minutes",
-        default=600000,
+        default=1,
+        help="Number of dispatcher threads, more than one implies --ack",
     )
+    add_consumer_arguments(server_subparser)
     server_subparser.set_defaults(func=start_server)
 
     # Client
@@ -249,18 +586,76 @@ if __name__ == "__main__":
         help="Name of the client queue, default is the name of the local host",
         default=os.uname()[1],
     )
+    client_subparser.add_argument(
+        "--executor",
+        choices=["celery", "native"],
+        default="celery",
+        help="Hand tasks to Celery workers, or run them in the client itself, "
+        "default is celery",
+    )
+    client_subparser.add_argument(
+        "--concurrency",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of tasks the native executor runs at once, default is the "
+        "number of CPUs",
+    )
+    client_subparser.add_argument(
+        "--heartbeat",
+        type=float,
+        metavar="SECONDS",
+        help="Report outstanding work to the server every this many seconds, for "
+        "a server with --routing least-outstanding, default is to not report",
+    )
+    add_consumer_arguments(client_subparser)
     client_subparser.set_defaults(func=start_client)
 
     # Database
     db_subparser = subparsers.add_parser("initdb", help="Database maintenance")
     db_subparser.set_defaults(func=maintain_db)
 
+    # Compile
+    compile_subparser = subparsers.add_parser(
+        "compile", help="Precompile the task configs for faster startup"
+    )
+    compile_subparser.set_defaults(func=compile_tasks)
+
+    # Retention
+    retention_subparser = subparsers.add_parser(
+        "retention", help="Archive and delete old messages and tasks"
+    )
+    retention_subparser.add_argument(
+        "--days", type=int, default=30, help="Keep this many days, default is 30"
+    )
+    retention_subparser.add_argument(
+        "--archive-dir",
+        help="Save purged rows as gzipped JSON lines per table and day, "
+        "default is to not archive",
+    )
+    retention_subparser.add_argument("--batch-size", type=int, default=5000)
+    retention_subparser.add_argument(
+        "--vacuum", action="store_true", help="Shrink the database file afterward"
+    )
+    retention_subparser.add_argument(
+        "--interval",
+        type=int,
+        help="Keep running and purge every this many seconds",
+    )
+    retention_subparser.set_defaults(func=retention)
+
     # Celery
     celery_subparser = subparsers.add_parser("celery", help="Start Celery worker")
     celery_subparser.add_argument(
         "--name",
         help="When using multiple workers, each one needs a unique name",
     )
+    celery_subparser.add_argument(
+        "-Q",
+        "--queue",
+        help="Run the tasks of this client queue, the --queue-name of the "
+        "client, default is the name of the local host",
+        default=os.uname()[1],
+    )
     celery_subparser.add_argument("--concurrency", type=int, default=8)
     celery_subparser.add_argument(
         "--loglevel", choices=("INFO", "WARN", "DEBUG"), default="INFO"
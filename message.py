@@ -1,9 +1,196 @@
 """
 Angora Message
 """
-from typing import Dict, Optional, Union
+import logging
+import socket
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
+from amqp.exceptions import MessageNacked  # type: ignore
 from kombu import Connection, Producer  # type: ignore
+from kombu.pools import producers  # type: ignore
+
+log = logging.getLogger(__name__)
+
+# Default retry policy used when a publish hits a connection error.  Kombu will
+# reconnect and revive the channel before trying again.
+RETRY_POLICY = {
+    "interval_start": 0,
+    "interval_step": 1,
+    "interval_max": 5,
+    "max_retries": 5,
+}
+
+
+class Publisher:
+    """
+    A long lived publisher.
+
+    Opening a connection for every message means a TCP and AMQP handshake for
+    every message.  The publisher holds on to one Connection and borrows
+    producers (and their channels) from kombu's process wide producer pool, so
+    connections and channels are reused across sends.  Kombu takes care of
+    resetting the pools after a fork, which keeps this safe to use in Celery
+    prefork workers.
+    """
+
+    def __init__(
+        self, connection_str: str, retry_policy: Optional[Dict] = None
+    ) -> None:
+        self.connection_str = connection_str
+        self.retry_policy = retry_policy or RETRY_POLICY
+        self.connection = Connection(connection_str)
+
+    def publish(
+        self,
+        body: Dict,
+        exchange: str,
+        routing_key: str,
+        expiration: Optional[float] = None,
+    ) -> None:
+        """
+        Publish a single message.  Connection errors are retried with
+        reconnects according to the retry policy.  With an expiration, in
+        seconds, the broker drops or dead letters the message once it's been
+        queued that long.
+        """
+        with producers[self.connection].acquire(block=True) as producer:
+            producer.publish(
+                body,
+                exchange=exchange,
+                routing_key=routing_key,
+                expiration=expiration,
+                retry=True,
+                retry_policy=self.retry_policy,
+            )
+
+    def publish_batch(
+        self,
+        batch: Iterable[Tuple[Dict, str, str]],
+        confirm: bool = False,
+        confirm_timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Publish several messages over one channel.  Each item in the batch is a
+        tuple of (body, exchange, routing_key).
+
+        With confirm set, the batch is published on a channel in confirm mode
+        and the broker acknowledgements are collected once at the end, instead
+        of waiting on each message.  If they don't all arrive within
+        confirm_timeout seconds, socket.timeout is raised.  On a connection
+        error the connection is revived and the whole batch is published again
+        according to the retry policy, so a message may go out twice.
+        Transports without publisher confirms fall back to a plain publish.
+        """
+        batch = list(batch)
+
+        with producers[self.connection].acquire(block=True) as producer:
+            if confirm and hasattr(producer.channel, "confirm_select"):
+                connection = producer.connection
+                max_retries = self.retry_policy.get("max_retries")
+                attempt = 0
+
+                while True:
+                    try:
+                        self._publish_confirmed(connection, batch, confirm_timeout)
+                        return
+                    except connection.recoverable_connection_errors:
+                        attempt += 1
+
+                        if max_retries is not None and attempt > max_retries:
+                            raise
+
+                        log.warning("Connection lost publishing a batch, retrying")
+                        connection.ensure_connection(**self.retry_policy)
+
+            for body, exchange, routing_key in batch:
+                producer.publish(
+                    body,
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    retry=True,
+                    retry_policy=self.retry_policy,
+                )
+
+    @staticmethod
+    def _publish_confirmed(
+        connection: Connection,
+        batch: Iterable[Tuple[Dict, str, str]],
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Publish on a fresh channel in confirm mode and wait for all the acks.
+        Delivery tags start at one on a new channel so the n-th message
+        published has tag n.  Raises MessageNacked if the broker rejects any
+        message and socket.timeout if the acks don't arrive in time.  A broker
+        that doesn't confirm won't close the channel either, so on a timeout
+        the connection is dropped without waiting and reconnects on next use.
+        """
+        channel = connection.channel()
+        pending = set()  # type: Set[int]
+        nacked = []  # type: List[int]
+
+        def on_ack(delivery_tag: int, multiple: bool) -> None:
+            if multiple:
+                pending.difference_update([_ for _ in pending if _ <= delivery_tag])
+            else:
+                pending.discard(delivery_tag)
+
+        def on_nack(delivery_tag: int, multiple: bool) -> None:
+            nacked.extend(
+                [_ for _ in pending if _ <= delivery_tag]
+                if multiple
+                else [delivery_tag]
+            )
+            on_ack(delivery_tag, multiple)
+
+        try:
+            channel.confirm_select()
+            channel.events["basic_ack"].add(on_ack)
+            channel.events["basic_nack"].add(on_nack)
+
+            producer = Producer(channel)
+
+            for tag, (body, exchange, routing_key) in enumerate(batch, 1):
+                pending.add(tag)
+                producer.publish(body, exchange=exchange, routing_key=routing_key)
+
+            while pending:
+                connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            connection.collect()
+            raise
+        finally:
+            if connection.connected:
+                channel.close()
+
+        if nacked:
+            raise MessageNacked(f"{len(nacked)} message(s) rejected by the broker")
+
+    def close(self) -> None:
+        producers[self.connection].force_close_all()
+        self.connection.release()
+
+
+_PUBLISHERS = {}  # type: Dict[str, Publisher]
+_PUBLISHERS_LOCK = threading.Lock()
+
+
+def get_publisher(
+    user: str, password: str, host: str, port: Union[str, int]
+) -> Publisher:
+    """
+    Return the process wide publisher for a broker, creating it on first use.
+    """
+    connection_str = f"amqp://{user}:{password}@{host}:{port}//"
+
+    with _PUBLISHERS_LOCK:
+        try:
+            return _PUBLISHERS[connection_str]
+        except KeyError:
+            publisher = _PUBLISHERS[connection_str] = Publisher(connection_str)
+
+            return publisher
 
 
 class Message:
@@ -17,6 +204,7 @@ class Message:
         "message",
         "time_stamp",
         "data",
+        "source",
     )
 
     def __init__(
@@ -26,6 +214,7 @@ class Message:
         message: str,
         time_stamp: Optional[str] = None,
         data: Optional[Dict] = None,
+        source: Optional[str] = None,
     ) -> None:
         """
         :param exchange: The RabbitMQ exchange
@@ -38,6 +227,8 @@ class Message:
         :type time_stamp: str
         :param data: Any serializable object
         :type data: object
+        :param source: Name of the task that sent the message, if any
+        :type source: str
         """
 
         self.exchange = exchange
@@ -45,6 +236,17 @@ class Message:
         self.message = message
         self.time_stamp = time_stamp
         self.data = data
+        self.source = source
+
+    def dict(self) -> Dict:
+        return {
+            "exchange": self.exchange,
+            "queue": self.queue,
+            "message": self.message,
+            "time_stamp": self.time_stamp,
+            "data": self.data,
+            "source": self.source,
+        }
 
     def send(
         self,
@@ -53,21 +255,35 @@ class Message:
         host: str,
         port: Union[str, int],
         routing_key: str,
+        expiration: Optional[float] = None,
     ) -> None:
         """
         Send the message to ampq message queue.  The body passed to publish()
-        must be JSON serializable (which a dictionary is).
+        must be JSON serializable (which a dictionary is).  The message goes
+        out through the shared publisher so the connection is reused.  See
+        Publisher.publish() for expiration.
         """
-        msg = {
-            "exchange": self.exchange,
-            "queue": self.queue,
-            "message": self.message,
-            "time_stamp": self.time_stamp,
-            "data": self.data,
-        }
+        get_publisher(user, password, host, port).publish(
+            self.dict(), self.exchange, routing_key, expiration
+        )
 
-        connection_str = f"amqp://{user}:{password}@{host}:{port}//"
 
-        with Connection(connection_str) as conn:
-            producer = Producer(conn)
-            producer.publish(msg, exchange=self.exchange, routing_key=routing_key)
+def send_batch(
+    batch: Iterable[Tuple[Message, str]],
+    user: str,
+    password: str,
+    host: str,
+    port: Union[str, int],
+    confirm: bool = False,
+    confirm_timeout: Optional[float] = None,
+) -> None:
+    """
+    Send several messages at once.  Each item in the batch is a tuple of
+    (message, routing_key).  All of them go out over a single channel of the
+    shared publisher, see Publisher.publish_batch().
+    """
+    get_publisher(user, password, host, port).publish_batch(
+        [(message.dict(), message.exchange, key) for message, key in batch],
+        confirm=confirm,
+        confirm_timeout=confirm_timeout,
+    )
@@ -0,0 +1,192 @@
+"""
+Angora Router
+"""
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, Iterator, List, Optional
+
+import kombu  # type: ignore
+
+from angora import EXCHANGE, HOST, PASSWORD, PORT, USER
+from listener import Queue
+from message import Message
+from task import Task
+
+log = logging.getLogger(__name__)
+
+STRATEGIES = ("round-robin", "least-outstanding")
+
+# Heartbeats are published to this queue, old ones are dropped if the server
+# isn't reading them
+HEARTBEAT_QUEUE = "heartbeat"
+HEARTBEAT_TTL = 60000
+
+
+def heartbeat_queue() -> Queue:
+    return Queue(
+        HEARTBEAT_QUEUE, HEARTBEAT_QUEUE, queue_args={"x-message-ttl": HEARTBEAT_TTL}
+    )
+
+
+class Router:
+    """
+    Picks the client queue each task is dispatched to.
+
+    The server knows the default client queues and any named pools of client
+    queues.  A task can pin a queue or a pool in its config, see Task.queue
+    and Task.pool.  Everything else goes to the default queues.  Within the
+    queues, the strategy picks one:
+
+        round-robin         each queue in turn
+        least-outstanding   the queue with the least work waiting or running,
+                            from the client heartbeats, see Heartbeat
+
+    Each dispatch counts towards a queue's outstanding work until the next
+    heartbeat from it replaces the count.  With least-outstanding, a queue
+    without a heartbeat in the last stale seconds is skipped, and when none of
+    the queues have one it falls back to round-robin.
+    """
+
+    def __init__(
+        self,
+        queues: List[str],
+        pools: Optional[Dict[str, List[str]]] = None,
+        strategy: str = "round-robin",
+        stale: float = 30.0,
+    ) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy}")
+
+        self.queues = list(queues)
+        self.pools = {name: list(pool) for name, pool in (pools or {}).items()}
+        self.strategy = strategy
+        self.stale = stale
+        self._turns = {}  # type: Dict[Optional[str], Iterator[int]]
+        self._outstanding = {}  # type: Dict[str, int]
+        self._seen = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+
+    def pick(self, task: Optional[Task] = None) -> str:
+        """
+        The client queue for the next run of task.
+        """
+        if task is not None and task.queue:
+            return task.queue
+
+        pool = task.pool if task is not None else None
+        queues = self.pools.get(pool) if pool else self.queues
+
+        if not queues:
+            log.warning("No client queues in pool %s, using the default", pool)
+            pool, queues = None, self.queues
+
+        with self._lock:
+            turn = next(self._turns.setdefault(pool, itertools.count()))
+            queue = queues[turn % len(queues)]
+
+            if self.strategy == "least-outstanding":
+                now = time.monotonic()
+                # Start from this turn so ties are spread around
+                order = [queues[(turn + i) % len(queues)] for i in range(len(queues))]
+                alive = [
+                    _
+                    for _ in order
+                    if _ in self._seen and now - self._seen[_] <= self.stale
+                ]
+
+                if alive:
+                    queue = min(alive, key=lambda _: self._outstanding.get(_, 0))
+
+            self._outstanding[queue] = self._outstanding.get(queue, 0) + 1
+
+        return queue
+
+    def heartbeat(self, payload: Dict, _: kombu.Message) -> None:
+        """
+        Listener callback for the heartbeat queue.
+        """
+        data = payload["data"]
+
+        with self._lock:
+            self._outstanding[data["queue"]] = data["outstanding"]
+            self._seen[data["queue"]] = time.monotonic()
+
+    def listen_heartbeats(self) -> None:
+        """
+        Read the client heartbeats on a background thread.
+        """
+        threading.Thread(
+            target=heartbeat_queue().listen,
+            args=([self.heartbeat],),
+            name="angora-heartbeats",
+            daemon=True,
+        ).start()
+
+
+class Heartbeat:
+    """
+    Reports a client's outstanding work to the server every interval seconds:
+    the messages waiting in its queues plus the tasks it's running.  Wrap each
+    task in track() for the running count.  Tasks handed off to Celery finish
+    out of sight, so with Celery only the messages waiting in the client queue
+    and its Celery queue are counted, not the ones the workers have taken.
+
+    The queues are the client queue first, which the report is for, and any
+    others whose backlog counts towards it.  They're all read over one
+    connection, kept open between beats.
+    """
+
+    def __init__(self, queues: List[Queue], interval: float = 5.0) -> None:
+        self.queues = queues
+        self.interval = interval
+        self.running = 0
+        self._lock = threading.Lock()
+        self._connection = kombu.Connection(queues[0].connection_str)
+
+    @contextmanager
+    def track(self) -> Generator:
+        with self._lock:
+            self.running += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="angora-heartbeat", daemon=True).start()
+
+    def outstanding(self) -> int:
+        waiting = 0
+
+        for queue in self.queues:
+            try:
+                waiting += queue.size(self._connection)
+            except self._connection.channel_errors:
+                # Not declared yet, e.g. a Celery queue before its first task
+                continue
+
+        return waiting + self.running
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                Message(
+                    EXCHANGE,
+                    HEARTBEAT_QUEUE,
+                    "heartbeat",
+                    data={
+                        "queue": self.queues[0].queue_name,
+                        "outstanding": self.outstanding(),
+                    },
+                ).send(USER, PASSWORD, HOST, PORT, HEARTBEAT_QUEUE)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Heartbeat failed")
+                # Reconnect on the next beat
+                self._connection.collect()
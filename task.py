@@ -1,22 +1,214 @@
 """
 Angora Task
 """
+import asyncio
+import contextlib
 import functools
+import hashlib
+import logging
 import os
+import pickle
+import random
 import re
 import shlex
+import signal
 import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
 from glob import glob
-from typing import Any, Dict, List, Optional, TextIO, Union
+from typing import Any, BinaryIO, ContextManager, Dict, List, Optional, Tuple, Union
 
 import yaml
 
+logger = logging.getLogger(__name__)
 
-class Task(dict):
+# Use the LibYAML based loader when PyYAML was built with it, it's many times
+# faster than the pure Python one
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Bump when the layout of the compiled catalog changes
+CATALOG_VERSION = 1
+
+# Command output is read this many bytes at a time
+CHUNK_SIZE = 65536
+
+# Seconds between terminating a timed out command and killing it
+KILL_GRACE = 5.0
+
+
+# $(date ...) in a command or log
+DATE_PATTERN = re.compile(r"\$\((date.*)\)")
+
+# Relative dates understood by date_sub() for -d/--date, anything else is left
+# to /bin/date
+RELATIVE_DATE = re.compile(r"^([+-]?\d+) (day|week)s?( ago)?$")
+
+
+def expand(value: str) -> str:
+    """
+    If you're not a stickler on the shell=True thing, then this is not
+    necessary.  Currently handles dates and envrionment variables.
+
+    The result only changes with the time, so it's memoized per minute, and
+    building or copying a Task never expands anything.
+    """
+    return _expand(value, int(time.time() // 60))
+
+
+@functools.lru_cache(maxsize=1024)
+def _expand(value: str, _minute: int) -> str:
+    # Safely expand date
+    try:
+        date_value = DATE_PATTERN.findall(value)[0]
+    except IndexError:
+        pass
+    else:
+        date_value = date_sub(date_value)
+        value = DATE_PATTERN.sub(lambda _: date_value, value)
+
+    # Expand environment variables
+    return os.path.expandvars(value)
+
+
+def date_sub(command: str) -> str:
+    """
+    Evaluate a date command, e.g. date '+%Y%m%d' or date -d yesterday +%F, in
+    process with strftime().  The formats are the same as date's on glibc.  A
+    command with options this doesn't handle is still run with /bin/date.
+    """
+    args = shlex.split(command)[1:]
+    fmt = "%a %b %e %H:%M:%S %Z %Y"
+    offset = timedelta()  # type: Optional[timedelta]
+    utc = False
+
+    while args and offset is not None:
+        arg = args.pop(0)
+
+        if arg.startswith("+"):
+            fmt = arg[1:]
+        elif arg in ("-u", "--utc", "--universal"):
+            utc = True
+        elif arg in ("-d", "--date") and args:
+            offset = _relative_date(args.pop(0), offset)
+        elif arg.startswith("--date="):
+            offset = _relative_date(arg[len("--date=") :], offset)
+        else:
+            offset = None
+
+    if offset is not None:
+        now = datetime.now(timezone.utc) if utc else datetime.now().astimezone()
+
+        return (now + offset).strftime(fmt)
+
+    output = subprocess.check_output(
+        shlex.split(command.replace("date", "/bin/date", 1)),
+        universal_newlines=True,
+    )
+
+    return output.splitlines()[0]
+
+
+def _relative_date(value: str, offset: timedelta) -> Optional[timedelta]:
     """
-    The Task object.  Stores all the task attributes and the run() method to
-    execute the task.  Inherits dict to make it JSON serializable.
+    Add a -d/--date value to the offset from now.  Returns None when the value
+    isn't one of the simple relative dates.
     """
+    value = value.strip().lower()
+
+    if value in ("now", "today"):
+        return offset
+    if value == "yesterday":
+        return offset - timedelta(days=1)
+    if value == "tomorrow":
+        return offset + timedelta(days=1)
+
+    match = RELATIVE_DATE.match(value)
+
+    if not match:
+        return None
+
+    count = int(match.group(1)) * (-1 if match.group(3) else 1)
+
+    return offset + timedelta(**{f"{match.group(2)}s": count})
+
+
+class Backoff:
+    """
+    How long a failed task waits before each replay.  The delay starts at base
+    seconds and is multiplied by multiplier on every attempt, up to max.
+    Jitter takes a random fraction, up to jitter, off each delay so tasks that
+    failed together don't all come back at the same moment.
+    """
+
+    __slots__ = ("base", "multiplier", "max", "jitter")
+
+    def __init__(
+        self,
+        base: float = 60,
+        multiplier: float = 2,
+        max: float = 3600,  # pylint: disable=redefined-builtin
+        jitter: float = 0.5,
+    ) -> None:
+        self.base = base
+        self.multiplier = multiplier
+        self.max = max
+        self.jitter = jitter
+
+    def __repr__(self) -> str:
+        return f"Backoff({self.dict()})"
+
+    def dict(self) -> Dict[str, float]:
+        return {
+            "base": self.base,
+            "multiplier": self.multiplier,
+            "max": self.max,
+            "jitter": self.jitter,
+        }
+
+    def delay(self, attempt: int) -> float:
+        """
+        Seconds to wait before replaying the attempt, counting from zero.
+        """
+        # Past a few dozen attempts any sane policy is at max, and a float
+        # power that large overflows
+        delay = min(self.max, self.base * self.multiplier ** min(attempt, 64))
+
+        return delay * (1 - self.jitter * random.random())
+
+
+DEFAULT_BACKOFF = Backoff()
+
+
+class Task:
+    """
+    The Task object.  Stores the task attributes as they're configured.
+
+    A Task is shared by everything that uses the catalog, so it's immutable and
+    uses __slots__ to stay small in large catalogs.  Anything that belongs to
+    a single execution lives in a TaskRun.  dict() is the JSON ready view of
+    the task, built once and cached.
+    """
+
+    __slots__ = (
+        "name",
+        "_command",
+        "triggers",
+        "_log",
+        "messages",
+        "parameters",
+        "parent_success",
+        "replay",
+        "timeout",
+        "backoff",
+        "queue",
+        "pool",
+        "config_source",
+        "parents",
+        "_view",
+    )
 
     def __init__(
         self,
@@ -24,23 +216,36 @@ class Task(dict):
         command: str,
         triggers: Optional[List] = None,
         log: Optional[str] = None,
-        messages: List = [],
-        parameters: List = [],
+        messages: Optional[List] = None,
+        parameters: Optional[List] = None,
         parent_success: bool = False,
         replay: Optional[int] = None,
+        timeout: Optional[float] = None,
+        backoff: Optional[Dict[str, float]] = None,
+        queue: Optional[str] = None,
+        pool: Optional[str] = None,
         config_source: Optional[str] = None,
         parents: Optional[List] = None,
     ) -> None:
-        self.name = name
-        self.command = command
-        self.triggers = triggers
-        self.log = log
-        self.parent_success = parent_success
-        self.replay = replay
-        self.config_source = config_source
-        self.parents = parents  # For determining parent success
-        self.messages = messages
-        self.parameters = parameters
+        init = functools.partial(object.__setattr__, self)
+        init("name", name)
+        init("_command", command)  # Expanded when read, see expand()
+        init("triggers", tuple(triggers or ()))
+        init("_log", log)
+        init("messages", tuple(messages or ()))
+        init("parameters", tuple(parameters or ()))  # Default run parameters
+        init("parent_success", parent_success)
+        init("replay", replay)
+        init("timeout", timeout)  # Seconds before the command is killed
+        init("backoff", Backoff(**backoff) if backoff else None)  # Replay delays
+        init("queue", queue)  # Client queue to always run on
+        init("pool", pool)  # Pool of client queues to run on
+        init("config_source", config_source)
+        init("parents", tuple(parents or ()))  # For determining parent success
+        init("_view", None)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        raise AttributeError(f"Task is immutable, can't set {key}")
 
     def __repr__(self) -> str:
         return (
@@ -50,6 +255,10 @@ class Task(dict):
             f"LOG: {self.log}\n"
             f"PARENT_SUCCESS: {self.parent_success}\n"
             f"REPLAY: {self.replay}\n"
+            f"TIMEOUT: {self.timeout}\n"
+            f"BACKOFF: {self.backoff}\n"
+            f"QUEUE: {self.queue}\n"
+            f"POOL: {self.pool}\n"
             f"CONFIG_SOURCE: {self.config_source}\n"
             f"PARENTS: {self.parents}\n"
             f"MESSAGES: {self.messages}\n"
@@ -58,90 +267,344 @@ class Task(dict):
 
     @property
     def command(self) -> str:
-        return self._command
-
-    @command.setter
-    def command(self, value: str) -> None:
-        self._command = self._expandvars(value)
+        return expand(self._command)
 
     @property
-    def log(self) -> str:
-        return self._log
+    def log(self) -> Optional[str]:
+        if self._log is None:
+            return None
 
-    @log.setter
-    def log(self, value) -> None:
-        self._log = self._expandvars(str(value))
+        log = expand(str(self._log))
 
-        if os.path.isdir(self._log):
+        if os.path.isdir(log):
             name = self.name.lower().replace(" ", "_")
-            self._log = os.path.join(self._log, f"{name}.log")
+            log = os.path.join(log, f"{name}.log")
 
-    def _expandvars(self, value: str) -> str:
+        return log
+
+    def _set_parents(self, parents: List[str]) -> None:
         """
-        If you're not a stickler on the shell=True thing, then this is not
-        necessary.  Currently handles dates and envrionment variables.
+        Parents come from the workflow graph, Tasks sets them on reload.
         """
-        # Safely expand date
-        pattern = re.compile(r"\$\((date.*)\)")
+        object.__setattr__(self, "parents", tuple(parents))
+        object.__setattr__(self, "_view", None)
 
-        try:
-            dateValue = pattern.findall(value)[0]
-        except IndexError:
-            pass
-        else:
-            date_sub = subprocess.check_output(
-                shlex.split(dateValue.replace("date", "/bin/date")),
-                universal_newlines=True,
+    def dict(self) -> Dict[str, Any]:
+        """
+        The task as a dictionary.  Command and log are the configured templates,
+        they're expanded where the task runs.  The dictionary is cached and
+        shared, copy it before making changes.
+        """
+        if self._view is None:
+            object.__setattr__(
+                self,
+                "_view",
+                {
+                    "name": self.name,
+                    "command": self._command,
+                    "triggers": list(self.triggers),
+                    "log": self._log,
+                    "parent_success": self.parent_success,
+                    "replay": self.replay,
+                    "timeout": self.timeout,
+                    "backoff": self.backoff.dict() if self.backoff else None,
+                    "queue": self.queue,
+                    "pool": self.pool,
+                    "config_source": self.config_source,
+                    "parents": list(self.parents),
+                    "messages": list(self.messages),
+                    "parameters": list(self.parameters),
+                },
             )
-            value = pattern.sub(date_sub.splitlines()[0], value)
 
-        # Expand environment variables
-        return os.path.expandvars(value)
+        return self._view
+
+
+class TaskRun:
+    """
+    One execution of a Task.  Holds the parameters it runs with, how many
+    replays it has left and which attempt this is, and the run() method to
+    execute the task.  A replay keeps the run id.
+    """
+
+    __slots__ = ("task", "parameters", "replay", "run_id", "attempt")
+
+    def __init__(
+        self,
+        task: Task,
+        parameters: Optional[List] = None,
+        replay: Optional[int] = None,
+        run_id: Optional[str] = None,
+        attempt: int = 0,
+    ) -> None:
+        self.task = task
+        self.parameters = task.parameters if parameters is None else parameters
+        self.replay = task.replay if replay is None else replay
+        self.run_id = run_id or uuid.uuid4().hex
+        self.attempt = attempt
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TaskRun":
+        """
+        Rebuild a run from dict(), e.g. the payload of a dispatched task.
+        """
+        data = dict(data)
+        parameters = data.pop("parameters", None)
+        replay = data.pop("replay", None)
+        run_id = data.pop("run_id", None)
+        attempt = data.pop("attempt", 0)
+
+        return cls(Task(**data, replay=replay), parameters, replay, run_id, attempt)
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.task!r}"
+            f"RUN PARAMETERS: {self.parameters}\n"
+            f"REPLAYS LEFT: {self.replay}\n"
+            f"RUN ID: {self.run_id}\n"
+            f"ATTEMPT: {self.attempt}\n"
+        )
+
+    @property
+    def command(self) -> str:
+        return self.task.command
+
+    @property
+    def log(self) -> Optional[str]:
+        return self.task.log
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            **self.task.dict(),
+            "parameters": self.parameters,
+            "replay": self.replay,
+            "run_id": self.run_id,
+            "attempt": self.attempt,
+        }
+
+    def reference(self, revision: str) -> Dict[str, Any]:
+        """
+        The run as dispatched to a client: the task is referred to by name and
+        the revision of the configs it came from, see Tasks.resolve().
+        """
+        return {
+            "name": self.task.name,
+            "revision": revision,
+            "parameters": self.parameters,
+            "replay": self.replay,
+            "run_id": self.run_id,
+            "attempt": self.attempt,
+        }
+
+    def next_replay(self) -> Optional[float]:
+        """
+        Take one replay out of the budget and move on to the next attempt.
+        Returns the number of seconds to wait before the replay, or None when
+        there are no replays left.  The budget is spent before the run is sent
+        back, so the replay carries what's left of it.
+        """
+        if self.replay is not None:
+            if self.replay <= 0:
+                return None
+
+            self.replay -= 1
+
+        delay = (self.task.backoff or DEFAULT_BACKOFF).delay(self.attempt)
+        self.attempt += 1
+
+        return delay
+
+    def _args(self) -> List[str]:
+        return shlex.split(self.command) + (
+            list(self.parameters) if self.parameters else []
+        )
+
+    def _output(self) -> ContextManager[Union[int, BinaryIO, None]]:
+        """
+        Where the command's stdout and stderr go.  With a log the file is handed
+        to the command, which writes to it directly.  Without one the output
+        goes to the logger at debug level, see OutputLogger, or is discarded
+        when debug logging is off.
+        """
+        log = self.log
+
+        if log:
+            return open(log, "ab")
+
+        if logger.isEnabledFor(logging.DEBUG):
+            return contextlib.nullcontext(subprocess.PIPE)
+
+        return contextlib.nullcontext(subprocess.DEVNULL)
 
     def run(self) -> int:
         """
         Tasks are just shell commands, but we don't use shell=True because
         that's frowned upon.  There's quite a bit of extra work done here
         because of that.
+
+        The command runs in its own session, so on timeout the whole process
+        group is killed, see kill_group().  Output is never held in memory
+        beyond one chunk.
         """
-        if self.log:
-            out = open(self.log, "a")  # type: Union[int, TextIO]
-        else:
-            out = subprocess.PIPE
+        timeout = self.task.timeout
+        timed_out = False
 
-        cmd = shlex.split(self.command) + (self.parameters if self.parameters else [])
+        with self._output() as out:
+            p = subprocess.Popen(
+                self._args(),
+                stdout=out,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
 
-        p = subprocess.Popen(
-            cmd,
-            stdout=out,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-        )
-        p.wait()
-        p.communicate()
+            pump = None
+
+            if p.stdout:
+                pump = threading.Thread(
+                    target=OutputLogger(self.task.name).pump,
+                    args=(p.stdout,),
+                    daemon=True,
+                )
+                pump.start()
+
+            try:
+                p.wait(timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                kill_group(p)
+
+            if pump:
+                pump.join(KILL_GRACE)
+
+        if timed_out:
+            self.write_log(f"TIMED OUT AFTER {timeout} SECONDS\n")
+
+        return p.returncode
+
+    async def run_async(self) -> int:
+        """
+        run() for asyncio.  Nothing blocks, so one event loop can supervise
+        many commands, e.g. with asyncio.gather().
+        """
+        timeout = self.task.timeout
+        timed_out = False
+
+        with self._output() as out:
+            p = await asyncio.create_subprocess_exec(
+                *self._args(),
+                stdout=out,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+            pump = None
+
+            if p.stdout:
+                pump = asyncio.ensure_future(
+                    OutputLogger(self.task.name).pump_async(p.stdout)
+                )
+
+            try:
+                await asyncio.wait_for(p.wait(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                await kill_group_async(p)
+
+            if pump:
+                try:
+                    await asyncio.wait_for(pump, KILL_GRACE)
+                except asyncio.TimeoutError:
+                    pass
+
+        if timed_out:
+            self.write_log(f"TIMED OUT AFTER {timeout} SECONDS\n")
 
         return p.returncode
 
     def write_log(self, text: str) -> None:
-        if self.log:
-            with open(self.log, "a") as log:
-                log.write(text)
+        log = self.log
+
+        if log:
+            with open(log, "a") as out:
+                out.write(text)
         else:
             print(text)  # TODO: Don't use print
 
-    def dict(self) -> Dict[str, Any]:
-        return {
-            "name": self.name,
-            "command": self.command,
-            "triggers": self.triggers,
-            "log": self.log,
-            "parent_success": self.parent_success,
-            "replay": self.replay,
-            "config_source": self.config_source,
-            "parents": self.parents,
-            "messages": self.messages,
-            "parameters": self.parameters,
-        }
+
+class OutputLogger:
+    """
+    Sends a command's output to the logger a line at a time.  Output is read in
+    chunks and at most one partial line is held back, so a chatty command
+    can't use up memory.
+    """
+
+    __slots__ = ("name", "partial")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.partial = b""
+
+    def write(self, chunk: bytes) -> None:
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+
+        if len(self.partial) >= CHUNK_SIZE:
+            lines.append(self.partial)
+            self.partial = b""
+
+        for line in lines:
+            logger.debug("%s: %s", self.name, line.decode(errors="replace"))
+
+    def close(self) -> None:
+        if self.partial:
+            self.write(b"\n")
+
+    def pump(self, stream: BinaryIO) -> None:
+        for chunk in iter(functools.partial(stream.read1, CHUNK_SIZE), b""):
+            self.write(chunk)
+
+        self.close()
+
+    async def pump_async(self, stream: asyncio.StreamReader) -> None:
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            self.write(chunk)
+
+        self.close()
+
+
+def kill_group(p: subprocess.Popen) -> None:
+    """
+    Terminate a command and everything it started, then kill whatever is left
+    after KILL_GRACE seconds.  The command has to be the leader of its process
+    group, i.e. started with start_new_session.
+    """
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        p.wait(KILL_GRACE)
+    except ProcessLookupError:
+        return
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+
+
+async def kill_group_async(p: asyncio.subprocess.Process) -> None:
+    """
+    kill_group() for asyncio.
+    """
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+        await asyncio.wait_for(p.wait(), KILL_GRACE)
+    except ProcessLookupError:
+        return
+    except asyncio.TimeoutError:
+        os.killpg(p.pid, signal.SIGKILL)
+        await p.wait()
 
 
 class Tasks:
@@ -149,17 +612,29 @@ class Tasks:
     List of tasks from parsing a config file.
 
     Once the list of tasks is constructed, this class has several methods to
-    make accessing tasks in different ways simpler.
+    make accessing tasks in different ways simpler.  Nothing is loaded until
+    the tasks are first used, so creating a Tasks object at import time is
+    cheap.
     """
 
-    def __init__(self, configs: str) -> None:
+    def __init__(
+        self, configs: str, catalog: Optional[str] = None, cache_size: int = 1024
+    ) -> None:
         self.configs = configs
+        self.catalog = catalog
+        self.cache_size = cache_size
         self._tasks = []  # type: List[Task]
+        self._by_trigger = {}  # type: Dict[str, List[Task]]
+        self._by_name = {}  # type: Dict[str, Task]
+        self._files = {}  # type: Dict[str, ConfigFile]
+        self._lock = threading.Lock()
+        self._unwatch = threading.Event()
         self.__tree = Graph()
-
-        self.reload()
+        self._revision = ""
+        self._loaded = False
 
     def __iter__(self):
+        self._ensure_loaded()
         self.__index = 0
         return self
 
@@ -171,81 +646,353 @@ class Tasks:
         else:
             raise StopIteration
 
-    @functools.lru_cache(maxsize=None)
-    def get_tasks_by_trigger(self, trigger: str) -> List:
-        return [task for task in self._tasks if trigger in task.triggers]
+    @property
+    def tasks(self) -> List[Dict[str, Any]]:
+        """
+        All the tasks as dictionaries, see Task.dict().
+        """
+        self._ensure_loaded()
+        return [task.dict() for task in self._tasks]
+
+    @property
+    def revision(self) -> str:
+        """
+        Short hash of the content of every config file.  Two processes with the
+        same task configs have the same revision, wherever they're installed.
+        """
+        self._ensure_loaded()
+        return self._revision
+
+    def get_tasks_by_trigger(self, trigger: str) -> List[Task]:
+        self._ensure_loaded()
+        return self._by_trigger.get(trigger, [])
 
-    @functools.lru_cache(maxsize=None)
     def get_task_by_name(self, name: str) -> Union[Task, None]:
-        for task in self._tasks:
-            if task.name == name:
-                return task
+        self._ensure_loaded()
+        return self._by_name.get(name)
 
-        return None
+    def get_child_tree(self, name: str, depth: Optional[int] = None) -> Dict:
+        """
+        All the descendants of a task, mapped to their immediate children.  See
+        _walk() for depth.
+        """
+        self._ensure_loaded()
+        return self._walk_cached(name, "children", depth)
+
+    def get_parent_tree(self, name: str, depth: Optional[int] = None) -> Dict:
+        """
+        All the ancestors of a task, mapped to their immediate parents.  See
+        _walk() for depth.
+        """
+        self._ensure_loaded()
+        return self._walk_cached(name, "parents", depth)
 
-    @functools.lru_cache(maxsize=None)
-    def get_child_tree(self, name: str) -> Dict:
-        children = {name: []}  # type: Dict[str, List[str]]
+    def _walk(self, name: str, direction: str, depth: Optional[int]) -> Dict:
+        """
+        Breadth first walk of the graph from name, following children or
+        parents.  Each task is expanded once, so a cycle in the workflow (A
+        messages B, B messages A) ends the walk instead of recursing forever.
+        The edge that closes the cycle is still listed.
+
+        With a depth, tasks that many steps away are included but not
+        expanded, they map to an empty list.
+        """
+        neighbours = getattr(self.__tree, direction)
+        tree = {}  # type: Dict[str, List[str]]
+        pending = deque([(name, 0)])
 
-        for edge in self.__tree.edges:
-            if name == edge.source:
-                children[name].append(edge.destination)
-                children.update(self.get_child_tree(edge.destination))
+        while pending:
+            task, level = pending.popleft()
 
-        return children
+            if task in tree:
+                continue
 
-    @functools.lru_cache(maxsize=None)
-    def get_parent_tree(self, name: str) -> Dict:
-        parents = {name: []}  # type: Dict[str, List[str]]
+            if depth is not None and level >= depth:
+                tree[task] = []
+                continue
 
-        for edge in self.__tree.edges:
-            if name == edge.destination:
-                parents[name].append(edge.source)
-                parents.update(self.get_parent_tree(edge.source))
+            tree[task] = neighbours(task)
+            pending.extend((_, level + 1) for _ in tree[task] if _ not in tree)
 
-        return parents
+        return tree
 
-    def reload(self) -> None:
+    def reload(self, force: bool = False) -> bool:
         """
         Refresh the task list via a separate function.  This way you can pick up
         any changes without restarting anything.
 
-        First create a list of Task objects by scanning all the config files.
-        Afterward we loop over the tasks several times to create all the edges,
-        which are used for determining the parent and child trees for each task.
-        For the parent tree, we store the immediate parents in each task.  We
-        don't store the immediate children because there isn't a use for that
-        data yet.
+        Each config file is tracked by modification time and content hash.
+        Only new files and files whose content changed are parsed again, unless
+        force is set.  The tasks of changed and deleted files are taken out of
+        the indexes and the graph, and the new tasks are added in, so nothing
+        is rebuilt from scratch.  For the parent tree, we store the immediate
+        parents in each task.  We don't store the immediate children because
+        there isn't a use for that data yet.
+
+        Everything is built aside and published at the end, once the new tasks
+        have their parents, so other threads never see a task without them and
+        a reload that fails leaves the old tasks in place.
+
+        The first reload starts from the compiled catalog when there is one,
+        see compile().  Files that match the catalog are not parsed at all.
+
+        Returns True if anything changed.
+        """
+        with self._lock:
+            files = dict(self._files)
+
+            if not self._loaded and self.catalog and not force:
+                files.update(self._read_catalog())
+
+            paths = sorted(glob(self.configs))
+            changed = {}  # type: Dict[str, ConfigFile]
+
+            for path in paths:
+                config = files.get(path)
+                stat = os.stat(path)
+
+                if (
+                    config
+                    and not force
+                    and (config.mtime, config.size) == (stat.st_mtime_ns, stat.st_size)
+                ):
+                    continue
+
+                with open(path, "rb") as cfg:
+                    content = cfg.read()
+
+                digest = hashlib.sha1(content).hexdigest()
+
+                if config and not force and config.digest == digest:
+                    config.mtime, config.size = stat.st_mtime_ns, stat.st_size
+                    continue
+
+                changed[path] = ConfigFile(
+                    path,
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                    digest,
+                    yaml.load(content, Loader=YAML_LOADER) or [],
+                )
+
+            removed = [path for path in files if path not in paths]
+
+            if self._loaded and not changed and not removed:
+                return False
+
+            files.update(changed)
+
+            for path in removed:
+                del files[path]
+
+            tree, by_trigger, by_name = self._patch(files)
+            tasks = [task for path in paths for task in files[path].tasks]
+
+            for task in tasks:
+                task._set_parents(tree.parents(task.name))
+
+            revision = hashlib.sha1(
+                "\n".join(
+                    f"{os.path.basename(path)}:{files[path].digest}" for path in paths
+                ).encode()
+            ).hexdigest()[:12]
+
+            self._files = files
+            self.__tree = tree
+            self._by_trigger = by_trigger
+            self._by_name = by_name
+            self._tasks = tasks
+            self._walk_cached = functools.lru_cache(maxsize=self.cache_size)(self._walk)
+            self._revision = revision
+            self._loaded = True
+
+            return True
+
+    def resolve(self, data: Dict[str, Any]) -> TaskRun:
+        """
+        Rebuild a dispatched run from its reference, see TaskRun.reference().
+
+        If the reference was made from another revision of the configs, they're
+        reloaded first.  If the revisions still differ, the local definition of
+        the task is used.  Full task payloads, from before dispatching by
+        reference, are still accepted.  Raises LookupError if the payload has no
+        task name or the task isn't configured here.
+        """
+        if "command" in data:
+            return TaskRun.from_dict(data)
+
+        name = data.get("name")
+
+        if name is None:
+            raise LookupError("Dispatched task has no name")
+
+        if data.get("revision") != self.revision:
+            self.reload()
+
+            if data.get("revision") != self.revision:
+                logger.warning(
+                    "Task %s was dispatched from revision %s, running revision %s",
+                    name,
+                    data.get("revision"),
+                    self.revision,
+                )
+
+        task = self.get_task_by_name(name)
+
+        if task is None:
+            raise LookupError(f"Task {name} is not configured")
+
+        return TaskRun(
+            task,
+            data.get("parameters"),
+            data.get("replay"),
+            data.get("run_id"),
+            data.get("attempt", 0),
+        )
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.reload()
+
+    def compile(self) -> str:
         """
-        self._tasks.clear()
-        self.get_tasks_by_trigger.cache_clear()
-        self.get_task_by_name.cache_clear()
-        self.get_child_tree.cache_clear()
-        self.get_parent_tree.cache_clear()
+        Save the parsed config files to the catalog, a pickle of the YAML data
+        of each file along with its modification time, size and hash.  Loading
+        it skips YAML parsing for every file that hasn't changed since.  The
+        tasks themselves aren't stored, so the catalog doesn't depend on the
+        Task class.  The file is replaced atomically.
+        """
+        if not self.catalog:
+            raise ValueError("No catalog path set")
+
+        self.reload()
+
+        snapshot = {
+            "version": CATALOG_VERSION,
+            "configs": self.configs,
+            "files": {
+                path: (config.mtime, config.size, config.digest, config.configs)
+                for path, config in self._files.items()
+            },
+        }
+
+        tmp = f"{self.catalog}.{os.getpid()}.tmp"
+
+        with open(tmp, "wb") as catalog:
+            pickle.dump(snapshot, catalog, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp, self.catalog)
+
+        return self.catalog
+
+    def _read_catalog(self) -> Dict[str, "ConfigFile"]:
+        """
+        Load the compiled catalog.  A missing, unreadable or out of date catalog
+        is ignored and every config file is parsed.
+        """
+        try:
+            with open(self.catalog, "rb") as catalog:
+                snapshot = pickle.load(catalog)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return {}
+
+        if (
+            snapshot.get("version") != CATALOG_VERSION
+            or snapshot.get("configs") != self.configs
+        ):
+            return {}
+
+        return {
+            path: ConfigFile(path, *values)
+            for path, values in snapshot["files"].items()
+        }
+
+    def _patch(
+        self, files: Dict[str, "ConfigFile"]
+    ) -> Tuple["Graph", Dict[str, List[Task]], Dict[str, Task]]:
+        """
+        The graph and indexes for files, patched from the current ones.  Only
+        the tasks of config files that were added, replaced or removed are
+        touched.  The patching is done on copies, the current graph and indexes
+        are left alone.
+        """
+        tree = self.__tree.copy()
+        by_trigger = {key: list(value) for key, value in self._by_trigger.items()}
+        by_name = dict(self._by_name)
+
+        for path, config in self._files.items():
+            if files.get(path) is config:
+                continue
+
+            for task in config.tasks:
+                tree.remove_task(task.name, task.triggers, task.messages)
+
+                if by_name.get(task.name) is task:
+                    del by_name[task.name]
+
+                for trigger in task.triggers or []:
+                    by_trigger[trigger].remove(task)
+
+                    if not by_trigger[trigger]:
+                        del by_trigger[trigger]
+
+        for path, config in files.items():
+            if self._files.get(path) is config:
+                continue
+
+            for task in config.tasks:
+                tree.add_task(task.name, task.triggers, task.messages)
+                by_name[task.name] = task
+
+                for trigger in task.triggers or []:
+                    by_trigger.setdefault(trigger, []).append(task)
+
+        return tree, by_trigger, by_name
+
+    def watch(self, interval: float = 5.0) -> threading.Thread:
+        """
+        Poll the config files every interval seconds in a background thread and
+        reload them when they change.  Polling only costs a stat() per file as
+        long as nothing changed.  Call unwatch() to stop.
+        """
+
+        def poll() -> None:
+            while not self._unwatch.wait(interval):
+                try:
+                    if self.reload():
+                        logger.info("Reloaded task configs")
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Failed to reload task configs")
+
+        self._unwatch.clear()
+        thread = threading.Thread(target=poll, name="angora-config-watch", daemon=True)
+        thread.start()
 
-        for config in glob(self.configs):
-            with open(config, "r") as cfg:
-                tmp = yaml.full_load(cfg)
+        return thread
 
-                for task in tmp:
-                    task["config_source"] = os.path.basename(config)
+    def unwatch(self) -> None:
+        self._unwatch.set()
 
-                    self._tasks.append(Task(**task))
 
-        for task in self._tasks:
-            out_ = [(task.name, message) for message in task.messages]
-            in_ = [(task.name, trigger) for trigger in task.triggers]
+class ConfigFile:
+    """
+    A parsed config file and what's needed to tell if it has changed.  configs
+    is the YAML data, one dictionary per task.
+    """
 
-        for overtex, oedge in out_:
-            for ivertex, iedge in in_:
-                if oedge == iedge:
-                    self.__tree.add_edge(Edge(iedge, overtex, ivertex))
+    __slots__ = ("mtime", "size", "digest", "configs", "tasks")
 
-        # get_parent_tree is recursive and we only need the first level, because
-        # the function is cached and we use the data in other places we don't
-        # incur a heavy penalty
-        for task in self._tasks:
-            task.parents = self.get_parent_tree(task.name)[task.name]
+    def __init__(
+        self, path: str, mtime: int, size: int, digest: str, configs: List[Dict]
+    ) -> None:
+        self.mtime = mtime
+        self.size = size
+        self.digest = digest
+        self.configs = configs
+        self.tasks = [
+            Task(**{**config, "config_source": os.path.basename(path)})
+            for config in configs
+        ]
 
 
 class Edge:
@@ -292,13 +1039,104 @@ class Graph:
     """
     The graph is a collection of edges.  The edges are formed by the message ->
     trigger relationships in the task.
+
+    Edges are kept in adjacency lists, by source for the children of a task,
+    by destination for its parents and by message.  Tasks are indexed by the
+    messages they send and the triggers they listen for, so adding a task only
+    looks at the tasks it actually connects to.
     """
 
     def __init__(self) -> None:
-        self.edges = []  # type: List[Edge]
+        self._out = {}  # type: Dict[str, List[Edge]]
+        self._in = {}  # type: Dict[str, List[Edge]]
+        self._by_message = {}  # type: Dict[str, List[Edge]]
+        self._senders = {}  # type: Dict[str, List[str]]
+        self._receivers = {}  # type: Dict[str, List[str]]
+
+    @property
+    def edges(self) -> List[Edge]:
+        return [edge for edges in self._out.values() for edge in edges]
+
+    def copy(self) -> "Graph":
+        """
+        A copy that can be changed without touching this graph.  The edges
+        themselves are shared.
+        """
+        graph = Graph()
+
+        for index in ("_out", "_in", "_by_message", "_senders", "_receivers"):
+            setattr(
+                graph,
+                index,
+                {key: list(value) for key, value in getattr(self, index).items()},
+            )
+
+        return graph
 
     def add_edge(self, edge: Edge) -> None:
-        self.edges.append(edge)
+        self._out.setdefault(edge.source, []).append(edge)
+        self._in.setdefault(edge.destination, []).append(edge)
+        self._by_message.setdefault(edge.name, []).append(edge)
+
+    def add_task(
+        self,
+        name: str,
+        triggers: Optional[List[str]] = None,
+        messages: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Add a task, connecting it to every task already in the graph that
+        sends one of its triggers or listens for one of its messages.
+        """
+        for message in messages or []:
+            for destination in self._receivers.get(message, []):
+                self.add_edge(Edge(message, name, destination))
+
+            self._senders.setdefault(message, []).append(name)
+
+        for trigger in triggers or []:
+            for source in self._senders.get(trigger, []):
+                self.add_edge(Edge(trigger, source, name))
+
+            self._receivers.setdefault(trigger, []).append(name)
+
+    def children(self, name: str) -> List[str]:
+        """
+        Immediate children of a task, each listed once.
+        """
+        return list(dict.fromkeys(edge.destination for edge in self._out.get(name, [])))
+
+    def parents(self, name: str) -> List[str]:
+        """
+        Immediate parents of a task, each listed once.
+        """
+        return list(dict.fromkeys(edge.source for edge in self._in.get(name, [])))
+
+    def remove_task(
+        self,
+        name: str,
+        triggers: Optional[List[str]] = None,
+        messages: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Remove a task and every edge to or from it.  The triggers and messages
+        must be the ones the task was added with.
+        """
+        for edge in self._out.pop(name, []) + self._in.pop(name, []):
+            for edges, key in (
+                (self._out, edge.source),
+                (self._in, edge.destination),
+                (self._by_message, edge.name),
+            ):
+                if key in edges:
+                    edges[key] = [_ for _ in edges[key] if _ is not edge]
+
+        for index, keys in ((self._senders, messages), (self._receivers, triggers)):
+            for key in keys or []:
+                index[key] = [_ for _ in index.get(key, []) if _ != name]
+
+    def get_edges_by_message(self, message: str) -> List[Edge]:
+        return self._by_message.get(message, [])
 
     def __repr__(self) -> str:
         return f"edges: {str(self.edges)}"
@@ -0,0 +1,10 @@
+"""
+Angora is imported both as the angora package and as top level modules, see
+main.py, so both the checkout and its parent go on the path.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path[:0] = [os.path.dirname(ROOT), ROOT]
@@ -0,0 +1,68 @@
+"""
+Replays are dispatched again by the server, spread over the client queues.
+"""
+import kombu  # type: ignore
+import pytest
+
+# main.py needs the Celery and web dependencies
+pytest.importorskip("celery")
+pytest.importorskip("uvicorn")
+
+# pylint: disable=wrong-import-position
+import main  # noqa: E402
+import message  # noqa: E402
+from router import Router  # noqa: E402
+from task import Tasks  # noqa: E402
+
+CLIENTS = ["client1", "client2", "client3"]
+
+
+def test_replays_spread_across_clients(monkeypatch, tmp_path):
+    publisher = message.Publisher("memory://")
+    monkeypatch.setattr(message, "get_publisher", lambda *_: publisher)
+    monkeypatch.setattr(main, "TASKS", Tasks(str(tmp_path / "*.yml")))
+
+    exchange = kombu.Exchange(main.EXCHANGE, type="direct")
+    router = Router(CLIENTS)
+
+    with kombu.Connection("memory://") as conn:
+        queues = {name: kombu.Queue(name, exchange, name)(conn) for name in CLIENTS}
+
+        for queue in queues.values():
+            queue.declare()
+
+        # What the replay queues dead letter to the server
+        for i in range(9):
+            payload = message.Message(
+                main.EXCHANGE,
+                "replay.60000",
+                "test.trigger",
+                data={"name": f"task_{i}", "run_id": str(i), "attempt": 1},
+            ).dict()
+            main.parse_task(payload, None, router=router)
+
+        received = {name: [] for name in CLIENTS}
+
+        for name, queue in queues.items():
+            while True:
+                delivery = queue.get(no_ack=True)
+
+                if delivery is None:
+                    break
+
+                received[name].append(delivery.payload)
+
+    publisher.close()
+
+    assert {name: len(payloads) for name, payloads in received.items()} == {
+        "client1": 3,
+        "client2": 3,
+        "client3": 3,
+    }
+
+    # The client still sees them as replays
+    assert all(
+        payload["queue"] == "replay.60000" and main.is_replay(payload)
+        for payloads in received.values()
+        for payload in payloads
+    )
@@ -2,13 +2,13 @@
 import argparse
 import re
 from collections import defaultdict
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 import uvicorn  # type: ignore
 from fastapi import FastAPI, Query
 from starlette.middleware.cors import CORSMiddleware
 
-from angora import CONFIGS, EXCHANGE, HOST, PASSWORD, PORT, USER
+from angora import CATALOG, CONFIGS, EXCHANGE, HOST, PASSWORD, PORT, USER
 from angora.db import db
 from angora.message import Message
 from angora.task import Tasks
@@ -16,7 +16,12 @@ from angora.task import Tasks
 app = FastAPI(version="0.0.1")
 app.add_middleware(CORSMiddleware, allow_origins=["*"])
 
-TASKS = Tasks(CONFIGS)
+TASKS = Tasks(CONFIGS, CATALOG)
+
+
+@app.on_event("startup")
+async def migrate_db():
+    db.ensure_db()
 
 
 @app.get("/send")
@@ -63,10 +68,9 @@ async def reload_tasks():
 
 @app.get("/tasks/today/notrun")
 async def get_tasks_notrun():
-    # all_tasks = TASKS.tasks
     tasks_today = {_["name"] for _ in db.get_tasks_today()}
 
-    notrun = [task for task in TASKS if task["name"] not in tasks_today]
+    notrun = [task for task in TASKS.tasks if task["name"] not in tasks_today]
 
     return {"data": notrun}
 
@@ -90,30 +94,24 @@ async def get_tasks_last_run_time(name=None):
     a dictionary (json) and you'll lose any attributes associated with the Task
     object.
 
-    TODO: make db.get_tasks_latest() accept an arg for better performance. Make
-    TASKS work when passing in a key.
+    TODO: Make TASKS work when passing in a key.
     """
     all_tasks = TASKS.tasks
-    last_task = db.get_tasks_latest()
 
     if name:
         all_tasks = [task for task in all_tasks if task["name"] == name]
 
-    for task in all_tasks:
-        status = None
-        time_stamp = None
+    # The task dictionaries are shared, copy them before adding the status
+    all_tasks = [dict(task) for task in all_tasks]
 
-        for lt in last_task:
-            if lt["name"] == task["name"]:
-                status = lt["status"]
+    # One row per task name, see db.TaskLatest
+    last_task = {lt["name"]: lt for lt in db.get_tasks_latest(name)}
 
-                if not time_stamp:
-                    time_stamp = lt["time_stamp"]
-                elif lt["time_stamp"] > time_stamp:
-                    time_stamp = lt["time_stamp"]
+    for task in all_tasks:
+        latest = last_task.get(task["name"], {})
 
-        task["status"] = status
-        task["time_stamp"] = time_stamp
+        task["status"] = latest.get("status")
+        task["time_stamp"] = latest.get("time_stamp")
 
     return {"data": all_tasks}
 
@@ -204,16 +202,16 @@ async def get_task_log(name):
     """
     This assumes that logs are files that are accessible to the API.
     """
-    for task in TASKS.tasks:
-        if task["name"] == name:
-            if not task.get("log"):
-                return {"ok": True, "data": "TASK NOT LOGGED"}
+    task = TASKS.get_task_by_name(name)
 
-            log = task.get("log")
-            break
-    else:
+    if task is None:
         return {"data": "NO MATCHING TASK"}
 
+    log = task.log
+
+    if not log:
+        return {"ok": True, "data": "TASK NOT LOGGED"}
+
     try:
         with open(log, "r") as _:
             return {"ok": True, "data": "".join(_.readlines()[-100:])}
@@ -222,72 +220,76 @@ async def get_task_log(name):
 
 
 @app.get("/task/children")
-async def get_task_children(name):
+async def get_task_children(name, depth: Optional[int] = None):
     """
-    Retrieve all the child tasks for a specified task.
+    Retrieve all the child tasks for a specified task, optionally only up to
+    depth levels down.
     """
-    return {"data": TASKS.get_child_tree(name)}
+    return {"data": TASKS.get_child_tree(name, depth)}
 
 
 @app.get("/task/children/lastruntime")
-async def get_task_children_lastruntime(name):
+async def get_task_children_lastruntime(name, depth: Optional[int] = None):
     """
     Retrieve all the child tasks for a specified task but also include the
     status and runtime of the most recently run instance.
     """
 
-    child_tree = TASKS.get_child_tree(name)
+    child_tree = TASKS.get_child_tree(name, depth)
     tasks_lastruntime = await get_tasks_last_run_time()
 
+    by_name = {task["name"]: task for task in tasks_lastruntime["data"]}
     data = {}
 
     for task_name, children in child_tree.items():
-        for task in tasks_lastruntime["data"]:
-            if task["name"] == task_name:
-                data[task_name] = {
-                    "status": task["status"],
-                    "time_stamp": task["time_stamp"],
-                    "children": children,
-                }
-                break
+        task = by_name.get(task_name)
+
+        if task is not None:
+            data[task_name] = {
+                "status": task["status"],
+                "time_stamp": task["time_stamp"],
+                "children": children,
+            }
 
     return {"data": data}
 
 
 @app.get("/task/parents")
-async def get_task_parents(name):
+async def get_task_parents(name, depth: Optional[int] = None):
     """
-    Retrieve all the parent tasks for a specified task.
+    Retrieve all the parent tasks for a specified task, optionally only up to
+    depth levels up.
     """
-    return {"data": TASKS.get_parent_tree(name)}
+    return {"data": TASKS.get_parent_tree(name, depth)}
 
 
 @app.get("/task/parents/lastruntime")
-async def get_task_parents_lastruntime(name):
+async def get_task_parents_lastruntime(name, depth: Optional[int] = None):
     """
     Retrieve all the parent tasks for a specified task but also include the
     status and runtime of the most recently run instance.
     """
-    parent_tree = TASKS.get_parent_tree(name)
+    parent_tree = TASKS.get_parent_tree(name, depth)
     tasks_lastruntime = await get_tasks_last_run_time()
 
+    by_name = {task["name"]: task for task in tasks_lastruntime["data"]}
     data = {}
 
     for task_name, parents in parent_tree.items():
-        for task in tasks_lastruntime["data"]:
-            if task["name"] == task_name:
-                data[task_name] = {
-                    "status": task["status"],
-                    "time_stamp": task["time_stamp"],
-                    "parents": parents,
-                }
-                break
+        task = by_name.get(task_name)
+
+        if task is not None:
+            data[task_name] = {
+                "status": task["status"],
+                "time_stamp": task["time_stamp"],
+                "parents": parents,
+            }
 
     return {"data": data}
 
 
 @app.get("/task/family/lastruntime")
-async def get_family_tree(name: str) -> Dict[str, Any]:
+async def get_family_tree(name: str, depth: Optional[int] = None) -> Dict[str, Any]:
     """
     Retrieve parents and children and combine into one dictionary.
 
@@ -297,8 +299,8 @@ async def get_family_tree(name: str) -> Dict[str, Any]:
     In Python 3.9+ you can use the "|"
     """
 
-    children = await get_task_children_lastruntime(name)
-    parents = await get_task_parents_lastruntime(name)
+    children = await get_task_children_lastruntime(name, depth)
+    parents = await get_task_parents_lastruntime(name, depth)
 
     data = defaultdict(lambda: {})  # type: Dict[str, Dict[str, Any]]
 